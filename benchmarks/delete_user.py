@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""Measure how long it takes to delete an account with many items.
+
+Creates a scratch SQLite database, fills it with one user owning `items`
+items (with tags) in a handful of categories, and times delete_user. The
+configured database is not touched.
+
+Usage: python benchmarks/delete_user.py [items]
+Run from the directory that contains config.py.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.getcwd(), ROOT]
+
+from sqlalchemy import create_engine, event
+
+from pemoi import app
+from pemoi.database_migrations import upgrade
+from pemoi.database_setup import User, Category, Item, Tag, item_tag
+from pemoi.pmoi_db_session import db_session
+from pemoi.pmoi_user import delete_user
+
+def seed(n_items, n_categories=20, n_tags=50):
+    """Create the admin, category 0 and a user with n_items items."""
+    db_session.add_all([User(id=0, name='Admin', username='admin',
+                             email='admin@local'),
+                        User(id=1, name='Heavy', username='heavy',
+                             email='heavy@local'),
+                        Category(id=0, name='No Category', user_id=0,
+                                 public=True)])
+    db_session.flush()
+    db_session.execute(Category.__table__.insert(), [
+        {'id': c, 'name': 'category %d' % c, 'user_id': 1,
+         'public': c % 2 == 0} for c in range(1, n_categories + 1)])
+    db_session.execute(Tag.__table__.insert(), [
+        {'id': t, 'name': 'tag%d' % t} for t in range(1, n_tags + 1)])
+    db_session.execute(Item.__table__.insert(), [
+        {'id': i, 'link': 'http://example.com/%d.jpg' % i, 'title': str(i),
+         'user_id': 1, 'category_id': i % n_categories + 1}
+        for i in range(1, n_items + 1)])
+    db_session.execute(item_tag.insert(), [
+        {'item_id': i, 'tag_id': i % n_tags + 1}
+        for i in range(1, n_items + 1)])
+    db_session.commit()
+
+def measure():
+    """Return seconds and number of statements needed to delete the user."""
+    statements = []
+    event.listen(db_session.get_bind(), 'before_cursor_execute',
+                 lambda *args: statements.append(1))
+    with app.test_request_context():
+        user = db_session.query(User).get(1)
+        start = time.perf_counter()
+        if not delete_user(user):
+            raise RuntimeError("delete_user failed")
+        elapsed = time.perf_counter() - start
+    return elapsed, len(statements)
+
+if __name__ == '__main__':
+    n_items = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    app.config['JOBS_INLINE'] = False
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine('sqlite:///' + os.path.join(directory, 'b.db'))
+        db_session.remove()
+        db_session.configure(bind=engine)
+        upgrade(engine)
+        seed(n_items)
+        elapsed, statements = measure()
+        db_session.remove()
+    print("delete_user with %d items: %.1f ms, %d SQL statements" %
+          (n_items, elapsed * 1000, statements))
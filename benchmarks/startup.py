@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+"""Measure how long it takes to import the pemoi package.
+
+Every uwsgi worker and every test run pays this once. Each sample imports
+the package in a fresh interpreter, so nothing is cached between runs.
+
+Usage: python benchmarks/startup.py [runs]
+Run from the directory that contains config.py.
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SNIPPET = ("import time; t = time.perf_counter(); import pemoi; "
+           "print(time.perf_counter() - t)")
+
+def measure(runs):
+    """Import pemoi in `runs` fresh interpreters, return the timings."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in (os.getcwd(), ROOT, env.get('PYTHONPATH')) if p)
+    timings = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', SNIPPET], env=env,
+                             check=True, stdout=subprocess.PIPE,
+                             universal_newlines=True).stdout
+        timings.append(float(out.strip().splitlines()[-1]))
+    return timings
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    timings = measure(runs)
+    print("import pemoi: median %.1f ms, min %.1f ms, max %.1f ms (%d runs)" %
+          (statistics.median(timings) * 1000, min(timings) * 1000,
+           max(timings) * 1000, runs))
@@ -1,4 +1,9 @@
-"""Init file for package. Create flask app."""
+"""Init file for package. Create flask app.
+
+Importing the package has no side effects beyond registering routes: it does
+not touch the database or any third party service. Prepare the database once
+per deployment with `FLASK_APP=pemoi flask bootstrap`.
+"""
 from flask import Flask
 
 app = Flask(__name__)
@@ -6,6 +11,9 @@ app.config.from_object('config')
 # Get static path from config
 app.static_url_path=app.config.get('STATIC_FOLDER')
 
+import pemoi.pmoi_logging
+import pemoi.pmoi_metrics
+import pemoi.pmoi_api
 import pemoi.pmoi_auth
 import pemoi.pmoi_cat
 import pemoi.fboauth
@@ -13,14 +21,14 @@ import pemoi.githuboauth
 import pemoi.googleoauth
 import pemoi.pmoi_index
 import pemoi.pmoi_item
+import pemoi.pmoi_search
+import pemoi.pmoi_tags
 import pemoi.pmoi_tumblr
 import pemoi.pmoi_user
 import pemoi.pmoi_helpers
-
-# Make sure that admin and category 0 exist when starting the app.
-admin = pemoi.pmoi_helpers.get_or_create_admin()
-cat_zero = pemoi.pmoi_helpers.get_or_create_cat_zero()
+import pemoi.pmoi_sessions
+import pemoi.pmoi_cli
 
 @app.context_processor
 def categories_for_menu():
-    return dict(categories=pemoi.pmoi_cat.get_categories())
+    return dict(categories=pemoi.pmoi_cat.get_menu_categories())
@@ -0,0 +1,278 @@
+"""Versioned schema migrations for the database.
+
+The schema version is stored in the table schema_version. Every migration
+is a function that receives a connection and runs inside its own
+transaction, together with the version bump. upgrade() applies all pending
+migrations in order, so a new database is built step by step the same way
+an existing production database is upgraded in place.
+
+To change the schema, change the models in database_setup.py and append a
+migration to MIGRATIONS that brings an existing database to the new state.
+Migration 1 creates new tables in their current form, so later migrations
+must skip changes that are already present.
+"""
+
+import logging
+
+from sqlalchemy import Column, Integer, MetaData, Table, inspect, func, select
+from sqlalchemy.schema import CreateColumn
+
+from .database_setup import Base
+
+schema_version = Table('schema_version', MetaData(),
+                       Column('version', Integer, nullable=False))
+
+log = logging.getLogger(__name__)
+
+
+def _create_tables(conn):
+    """Create all tables that do not exist yet."""
+    Base.metadata.create_all(conn)
+
+def _rename_duplicate_public_categories(conn):
+    """Give public categories that share a name unique names.
+
+    The oldest category keeps the name, the others get their ID appended,
+    e.g. 'Posters (12)'. Their items stay where they are. Needed before
+    the unique index on public names can be created.
+    """
+    category = Base.metadata.tables['category']
+    public = category.c.public==True
+    taken = set(name for name, in conn.execute(
+        select([category.c.name]).where(public)))
+    duplicates = select([category.c.name]).where(public)\
+                     .group_by(category.c.name)\
+                     .having(func.count(category.c.id) > 1)
+    rows = conn.execute(select([category.c.id, category.c.name])
+                        .where(public & category.c.name.in_(duplicates))
+                        .order_by(category.c.name, category.c.id)).fetchall()
+    kept = set()
+    for id, name in rows:
+        if name not in kept:
+            kept.add(name)
+            continue
+        suffix, n = ' (%d)' % id, 1
+        new_name = name[:100 - len(suffix)] + suffix
+        while new_name in taken:
+            n += 1
+            suffix = ' (%d-%d)' % (id, n)
+            new_name = name[:100 - len(suffix)] + suffix
+        taken.add(new_name)
+        conn.execute(category.update().where(category.c.id==id)
+                     .values(name=new_name))
+        log.warning("Renamed public category %d from %r to %r, its name "
+                    "was taken", id, name, new_name)
+
+def _create_missing_indexes(conn):
+    """Create indexes declared on the models that the database lacks.
+
+    Tables created by create_all already have all their indexes, tables that
+    existed before only get the ones that are missing. Duplicate public
+    category names are renamed before their unique index is created.
+    """
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                if index.name == 'ix_category_public_name':
+                    _rename_duplicate_public_categories(conn)
+                index.create(conn)
+
+def _add_columns(table, *names):
+    """Return a migration that adds the named model columns to table."""
+    def migrate(conn):
+        existing = set(c['name'] for c in inspect(conn).get_columns(table))
+        for name in names:
+            if name not in existing:
+                column = Base.metadata.tables[table].c[name]
+                conn.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                    conn.dialect.identifier_preparer.quote(table),
+                    CreateColumn(column).compile(dialect=conn.dialect)))
+    return migrate
+
+def _add_job_queue(conn):
+    """Create the job table and the processing status of items."""
+    _create_tables(conn)
+    _add_columns('item', 'status')(conn)
+
+# Full-text search, see pmoi_search
+SEARCH_COLUMNS = ('title', 'artist', 'note', 'keywords')
+# Text search configuration for PostgreSQL, 'simple' does no stemming
+PG_TS_CONFIG = 'simple'
+PG_DOCUMENT = "to_tsvector('%s', %s)" % (
+    PG_TS_CONFIG,
+    " || ' ' || ".join("coalesce(item.%s, '')" % c for c in SEARCH_COLUMNS))
+SQLITE_SEARCH_DDL = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS item_fts USING fts5(
+           title, artist, note, keywords, content='item', content_rowid='id')""",
+    """CREATE TRIGGER IF NOT EXISTS item_fts_insert AFTER INSERT ON item BEGIN
+           INSERT INTO item_fts(rowid, title, artist, note, keywords)
+           VALUES (new.id, new.title, new.artist, new.note, new.keywords);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS item_fts_delete AFTER DELETE ON item BEGIN
+           INSERT INTO item_fts(item_fts, rowid, title, artist, note, keywords)
+           VALUES ('delete', old.id, old.title, old.artist, old.note,
+                   old.keywords);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS item_fts_update
+           AFTER UPDATE OF title, artist, note, keywords ON item BEGIN
+           INSERT INTO item_fts(item_fts, rowid, title, artist, note, keywords)
+           VALUES ('delete', old.id, old.title, old.artist, old.note,
+                   old.keywords);
+           INSERT INTO item_fts(rowid, title, artist, note, keywords)
+           VALUES (new.id, new.title, new.artist, new.note, new.keywords);
+       END""",
+    # Index all existing items
+    "INSERT INTO item_fts(item_fts) VALUES ('rebuild')",
+)
+POSTGRESQL_SEARCH_DDL = (
+    "CREATE INDEX IF NOT EXISTS ix_item_search ON item USING gin (%s)"
+        % PG_DOCUMENT,
+)
+
+def sqlite_has_fts5(conn):
+    """Return True if the SQLite library was built with FTS5."""
+    options = [row[0] for row in conn.execute('PRAGMA compile_options')]
+    return 'ENABLE_FTS5' in options
+
+def _create_search_index(conn):
+    """Create the full-text index that fits the database.
+
+    SQLite gets an FTS5 table that triggers keep in sync with item,
+    PostgreSQL a GIN index on the items' tsvector. Other databases, and
+    SQLite without FTS5, fall back to LIKE searches without an index.
+    """
+    ddl = ()
+    if conn.dialect.name == 'sqlite':
+        if sqlite_has_fts5(conn):
+            ddl = SQLITE_SEARCH_DDL
+    elif conn.dialect.name == 'postgresql':
+        ddl = POSTGRESQL_SEARCH_DDL
+    for statement in ddl:
+        conn.execute(statement)
+
+# Item counts of categories, see Category. The triggers update the counts in
+# the same transaction as the items, also for bulk statements.
+CATEGORY_COUNT_BACKFILL = """
+    UPDATE category SET
+        item_count = (SELECT count(*) FROM item
+                      WHERE item.category_id = category.id),
+        public_item_count = (SELECT count(*) FROM item
+                             WHERE item.category_id = category.id
+                             AND item.public)"""
+SQLITE_COUNT_DDL = (
+    """CREATE TRIGGER IF NOT EXISTS category_count_insert
+           AFTER INSERT ON item BEGIN
+           UPDATE category SET item_count = item_count + 1,
+               public_item_count = public_item_count
+                   + (CASE WHEN new.public THEN 1 ELSE 0 END)
+           WHERE id = new.category_id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS category_count_delete
+           AFTER DELETE ON item BEGIN
+           UPDATE category SET item_count = item_count - 1,
+               public_item_count = public_item_count
+                   - (CASE WHEN old.public THEN 1 ELSE 0 END)
+           WHERE id = old.category_id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS category_count_update
+           AFTER UPDATE OF category_id, public ON item BEGIN
+           UPDATE category SET item_count = item_count - 1,
+               public_item_count = public_item_count
+                   - (CASE WHEN old.public THEN 1 ELSE 0 END)
+           WHERE id = old.category_id;
+           UPDATE category SET item_count = item_count + 1,
+               public_item_count = public_item_count
+                   + (CASE WHEN new.public THEN 1 ELSE 0 END)
+           WHERE id = new.category_id;
+       END""",
+)
+POSTGRESQL_COUNT_DDL = (
+    """CREATE OR REPLACE FUNCTION category_count() RETURNS trigger AS $$
+       BEGIN
+           IF TG_OP IN ('UPDATE', 'DELETE') THEN
+               UPDATE category SET item_count = item_count - 1,
+                   public_item_count = public_item_count
+                       - (CASE WHEN OLD.public THEN 1 ELSE 0 END)
+               WHERE id = OLD.category_id;
+           END IF;
+           IF TG_OP IN ('UPDATE', 'INSERT') THEN
+               UPDATE category SET item_count = item_count + 1,
+                   public_item_count = public_item_count
+                       + (CASE WHEN NEW.public THEN 1 ELSE 0 END)
+               WHERE id = NEW.category_id;
+           END IF;
+           RETURN NULL;
+       END;
+       $$ LANGUAGE plpgsql""",
+    "DROP TRIGGER IF EXISTS category_count_insert_delete ON item",
+    """CREATE TRIGGER category_count_insert_delete
+           AFTER INSERT OR DELETE ON item
+           FOR EACH ROW EXECUTE PROCEDURE category_count()""",
+    "DROP TRIGGER IF EXISTS category_count_update ON item",
+    """CREATE TRIGGER category_count_update
+           AFTER UPDATE OF category_id, public ON item
+           FOR EACH ROW EXECUTE PROCEDURE category_count()""",
+)
+# Databases whose category item counts are maintained
+CATEGORY_COUNT_DDL = {
+    'sqlite': SQLITE_COUNT_DDL,
+    'postgresql': POSTGRESQL_COUNT_DDL,
+}
+
+def _add_category_counts(conn):
+    """Add item counts to categories and the triggers that maintain them.
+
+    Other databases than SQLite and PostgreSQL get the columns, but no
+    triggers, so their counts are not shown.
+    """
+    _add_columns('category', 'item_count', 'public_item_count')(conn)
+    ddl = CATEGORY_COUNT_DDL.get(conn.dialect.name, ())
+    for statement in ddl:
+        conn.execute(statement)
+    conn.execute(CATEGORY_COUNT_BACKFILL)
+
+# List of (version, description, function), in order
+MIGRATIONS = [
+    (1, "Create tables", _create_tables),
+    (2, "Indexes for hot filter columns", _create_missing_indexes),
+    (3, "Resized image variants for items",
+     _add_columns('item', 'thumb_link', 'srcset', 'webp_srcset')),
+    (4, "Background job queue", _add_job_queue),
+    (5, "Index on item links for content-addressed uploads",
+     _create_missing_indexes),
+    (6, "Full-text search index", _create_search_index),
+    # Existing keywords are parsed by 'flask backfill-tags'
+    (7, "Tags", _create_tables),
+    (8, "Tumblr imports", _create_tables),
+    (9, "Item counts of categories", _add_category_counts),
+]
+
+
+def current_version(conn):
+    """Return the schema version of the database, 0 for an empty database."""
+    schema_version.create(conn, checkfirst=True)
+    version = conn.execute(schema_version.select()).scalar()
+    return version or 0
+
+def upgrade(engine, target=None):
+    """Apply all pending migrations up to target (default: latest).
+
+    Arguments: SQLAlchemy engine, target version as int (optional).
+    Return: The schema version after upgrading.
+    """
+    with engine.begin() as conn:
+        version = current_version(conn)
+    for number, description, migrate in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        with engine.begin() as conn:
+            migrate(conn)
+            if version:
+                conn.execute(schema_version.update().values(version=number))
+            else:
+                conn.execute(schema_version.insert().values(version=number))
+        log.info("Migrated database to version %d: %s", number, description)
+        version = number
+    return version
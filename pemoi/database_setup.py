@@ -1,4 +1,7 @@
-"""Set up the database, create tables User, Category, Items"""
+"""Set up the database, create tables User, Category, Items, Tag, Job,
+TumblrImport"""
+
+from datetime import datetime
 
 from sqlalchemy import Column, \
                        ForeignKey, \
@@ -7,11 +10,13 @@ from sqlalchemy import Column, \
                        DateTime, \
                        Boolean, \
                        UnicodeText, \
-                       create_engine
+                       Text, \
+                       Table, \
+                       Index, \
+                       exists
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, object_session
 from sqlalchemy.sql import func
-from pemoi import app
 Base = declarative_base()
 
 class User(Base):
@@ -51,6 +56,10 @@ class Category(Base):
     add_date: DateTime of addition, auto-generated
     public: Boolean, so that the user can decide whether or not to make a
             category public (private is default)
+    item_count: Integer, number of items in the category
+    public_item_count: Integer, number of public items in the category
+    Both counts are kept up to date by database triggers, see
+    database_migrations.
 
     The following fields have to be provided: name, user_id, public
     """
@@ -63,6 +72,16 @@ class Category(Base):
     items = relationship('Item', back_populates="category")
     add_date = Column(DateTime(timezone=True), server_default=func.now())
     public = Column(Boolean, default=False)
+    item_count = Column(Integer, nullable=False, server_default='0')
+    public_item_count = Column(Integer, nullable=False, server_default='0')
+
+    __table_args__ = (
+        # Public category names are unique, see name_exists
+        Index('ix_category_public_name', 'name', unique=True,
+              postgresql_where=(public==True), sqlite_where=(public==True)),
+        Index('ix_category_public_id', 'public', 'id'),
+        Index('ix_category_user_id_public', 'user_id', 'public'),
+    )
 
     @property
     def serialize(self):
@@ -83,11 +102,26 @@ class Category(Base):
 
         Check if category has items other than user's own, if yes, don't
         allow setting it to private"""
-        allow = True
-        for item in self.items:
-            if item.user_id != self.user_id:
-                allow = False
-        return allow
+        if self.id is None:
+            # Not saved yet, so it has no items
+            return True
+        others = exists().where((Item.category_id==self.id)
+                                &(Item.user_id!=self.user_id))
+        return not object_session(self).query(others).scalar()
+
+    def is_empty(self):
+        """Check if category has no items, including other users' private
+        items"""
+        items = exists().where(Item.category_id==self.id)
+        return not object_session(self).query(items).scalar()
+
+# Association between items and their tags
+item_tag = Table('item_tag', Base.metadata,
+    Column('item_id', Integer, ForeignKey('item.id'), primary_key=True),
+    Column('tag_id', Integer, ForeignKey('tag.id'), primary_key=True),
+    # Items by tag, the primary key covers tags by item
+    Index('ix_item_tag_tag_id_item_id', 'tag_id', 'item_id'),
+)
 
 class Item(Base):
     """Item class for item table
@@ -107,6 +141,14 @@ class Item(Base):
     user: Relationship to User class
     public: Boolean, so that the user can decide whether or not to share the
             inspiration
+    thumb_link: String for URL to the smallest resized variant of an upload.
+                Optional
+    srcset: String with all sizes of an upload for the img 'srcset'
+            attribute. Optional
+    webp_srcset: String with WebP sizes of an upload for 'srcset'. Optional
+    status: String, 'processing' while an upload is post-processed in the
+            background, 'ready' or 'failed' afterwards
+    tags: Relationship to Tag class, parsed from keywords
     """
     __tablename__ = "item"
     id = Column(Integer, primary_key=True)
@@ -121,7 +163,23 @@ class Item(Base):
     category = relationship('Category', back_populates="items")
     user_id = Column(Integer, ForeignKey('user.id'))
     user = relationship('User', back_populates="items")
+    tags = relationship('Tag', secondary=item_tag, back_populates="items")
     public = Column(Boolean, default=False)
+    thumb_link = Column(String(250))
+    srcset = Column(String(1000))
+    webp_srcset = Column(String(1000))
+    status = Column(String(20), default='ready')
+
+    __table_args__ = (
+        # Keyset pagination of the public feed, see pmoi_index
+        Index('ix_item_public_add_date_id', 'public', 'add_date', 'id'),
+        # Own items and category pages, also paginated by (add_date, id)
+        Index('ix_item_user_id_add_date_id', 'user_id', 'add_date', 'id'),
+        Index('ix_item_category_id_add_date_id',
+              'category_id', 'add_date', 'id'),
+        # Reference counting of uploads, see pmoi_storage
+        Index('ix_item_link', 'link'),
+    )
 
     @property
     def serialize(self):
@@ -139,8 +197,80 @@ class Item(Base):
                 'public': self.public,
             }
 
+class Tag(Base):
+    """Tag class for the tag table
+
+    Columns:
+    id: Primary key, auto-generated, incremental integer
+    name: String(50), lower case keyword, unique
+    items: Relationship to Item class
+    """
+    __tablename__ = "tag"
+    id = Column(Integer, primary_key=True)
+    # The unique index also serves prefix searches, see pmoi_tags
+    name = Column(String(50), nullable=False, unique=True)
+    items = relationship('Item', secondary=item_tag, back_populates="tags")
+
+class Job(Base):
+    """Job class for the job table, the queue of background jobs
+
+    Columns:
+    id: Primary key, auto-generated, incremental integer
+    kind: String naming the handler, see pmoi_jobs
+    payload: Text, JSON encoded keyword arguments for the handler
+    status: String, one of 'queued', 'running', 'done', 'failed'
+    attempts: Integer, number of times the job has been run
+    max_attempts: Integer, number of runs before the job is given up
+    run_after: DateTime (UTC) before which the job must not run
+    started: DateTime (UTC) when the job was last claimed by a worker
+    error: Text, traceback of the last failure
+    add_date: DateTime of addition, auto-generated
+    """
+    __tablename__ = "job"
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(50), nullable=False)
+    payload = Column(Text, nullable=False)
+    status = Column(String(20), nullable=False, default='queued')
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    run_after = Column(DateTime, nullable=False, default=datetime.utcnow)
+    started = Column(DateTime)
+    error = Column(Text)
+    add_date = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        # Workers look for the next due job
+        Index('ix_job_status_run_after', 'status', 'run_after'),
+    )
+
+class TumblrImport(Base):
+    """TumblrImport class for the tumblr_import table
 
-engine = create_engine(app.config['DB_URI'],
-                       convert_unicode=True)
+    Tracks the import of a whole Tumblr blog, which runs as a chain of
+    background jobs.
 
-Base.metadata.create_all(engine)
+    Columns:
+    id: Primary key, auto-generated, incremental integer
+    user_id: Foreign key of the user who imports the blog
+    blog: String, name of the Tumblr blog
+    tag: String, only import posts with this tag (optional)
+    status: String, one of 'queued', 'running', 'done', 'failed'
+    offset: Integer, number of posts that have been processed
+    total: Integer, number of posts of the blog (with the tag)
+    imported: Integer, number of items created
+    skipped: Integer, number of posts already saved or without usable image
+    add_date: DateTime of addition, auto-generated
+    edit_date: DateTime of last progress, updated on edit
+    """
+    __tablename__ = "tumblr_import"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
+    blog = Column(String(250), nullable=False)
+    tag = Column(String(250), nullable=False, default='')
+    status = Column(String(20), nullable=False, default='queued')
+    offset = Column(Integer, nullable=False, default=0)
+    total = Column(Integer)
+    imported = Column(Integer, nullable=False, default=0)
+    skipped = Column(Integer, nullable=False, default=0)
+    add_date = Column(DateTime(timezone=True), server_default=func.now())
+    edit_date = Column(DateTime(timezone=True), onupdate=func.now())
@@ -1,8 +1,6 @@
 """Facebook OAuth authentication"""
 
-import os
-import httplib2
-import json
+from urllib.parse import parse_qs
 
 from flask import request, \
                   session as login_session, \
@@ -11,17 +9,18 @@ from flask import request, \
 from pemoi import app
 
 from .pmoi_helpers import json_response
-from config import _basedir
+from .pmoi_oauth import load_secrets, provider_url, call, fetch_all, \
+                        ProviderError
 
 from . import pmoi_auth
 
+GRAPH_VERSION = 'v2.8'
+
 # Connect with Facebook
 @app.route('/fbconnect', methods=['POST'])
 def fbconnect():
     """Connect to facebook OAuth API"""
 
-    # Load JSON file from base directory
-    json_file = os.path.join(_basedir, 'fb_client_secrets.json')
     # Compare and validate STATE parameter, return error if invalid
     if request.args.get('state') != login_session['state']:
         response = "Invalid STATE parameter"
@@ -30,31 +29,37 @@ def fbconnect():
     access_token = request.data
 
     # Exchange client token for long-lived server side token
-    app_id = json.loads(open(json_file, 'r').read())['web']['app-id']
-    app_secret = json.loads(open(json_file, 'r').read())['web']['app-secret']
-    url = 'https://graph.facebook.com/oauth/access_token?grant_type=fb_exchange_token&client_id=%s&client_secret=%s&fb_exchange_token=%s' % (app_id, app_secret, access_token)
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-
-    # Use token to get user info
-    userinfo_url = 'https://graph.facebook.com/v2.8/me'
-    # Strip expire tag from token
-    token = result.split('&')[0]
-    url = 'https://graph.facebook.com/v2.8/me?%s&fields=name,id,email' % token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-    data = json.loads(result)
+    secrets = load_secrets('fb')
+    params = {'grant_type': 'fb_exchange_token',
+              'client_id': secrets['app-id'],
+              'client_secret': secrets['app-secret'],
+              'fb_exchange_token': access_token}
+    try:
+        result = call('GET', provider_url('facebook', '/oauth/access_token'),
+                      params=params)
+        token = exchanged_token(result)
+        if token is None:
+            return json_response("Failed to exchange the access token", 401)
+
+        # Get user info and profile picture at the same time
+        me = provider_url('facebook', '/%s/me' % GRAPH_VERSION)
+        profile, picture = fetch_all(
+            ('GET', me, {'params': {'access_token': token,
+                                    'fields': 'name,id,email'}}),
+            ('GET', me + '/picture', {'params': {'access_token': token,
+                                                 'redirect': 0,
+                                                 'height': 200,
+                                                 'width': 200}}))
+    except ProviderError:
+        return json_response("Facebook can not be reached right now", 504)
+    data = profile.json()
     # Store user info in session
     login_session['provider'] = 'Facebook'
     login_session['name'] = data['name']
     login_session['email'] = data['email']
     login_session['facebook_id'] = data['id']
-
-    # Get profile picture in separate call
-    url = 'https://graph.facebook.com/v2.8/me/picture?%s&redirect=0&height=200&width=200' % token
-    result = h.request(url, 'GET')[1]
-    data = json.loads(result)
-    login_session['picture'] = data['data']['url']
+    login_session['access_token'] = token
+    login_session['picture'] = picture.json()['data']['url']
     # Check if user exists in db
     user_id = pmoi_auth.get_user_id(login_session['email'])
     # if not, redirect to complete signup
@@ -67,12 +72,40 @@ def fbconnect():
     flash("Thanks for logging in, %s" % login_session['username'])
     return user.username
 
+def exchanged_token(response):
+    """Read the long-lived token from Facebook's token exchange.
+
+    Current API versions answer with JSON, older ones with a query string.
+    Return: Access token as string or None.
+    """
+    if response.status_code != 200:
+        return None
+    try:
+        return response.json().get('access_token')
+    except ValueError:
+        return parse_qs(response.text).get('access_token', [None])[0]
+
 # Facebook disconnect function
 @app.route('/fbdisconnect')
 def fbdisconnect():
     """Disconnect facebook session"""
-    facebook_id = login_session['facebook_id']
-    url = 'https://graph.facebook.com/%s/permissions' % facebook_id
-    h = httplib2.Http()
-    result = h.request(url, 'DELETE')[1]
+    try:
+        revoke_facebook(login_session['facebook_id'],
+                        login_session.get('access_token'))
+    except ProviderError:
+        pass
     return "You've been logged out"
+
+def revoke_facebook(facebook_id, access_token):
+    """Remove the app's permissions for a Facebook user.
+
+    Return: Boolean, False if Facebook refused, e.g. for an invalid token.
+    Raises ProviderError if Facebook can't be reached or has a problem, so
+    that the revocation can be tried again later.
+    """
+    url = provider_url('facebook', '/%s/permissions' % facebook_id)
+    result = call('DELETE', url, params={'access_token': access_token})
+    if result.status_code >= 500:
+        raise ProviderError("Facebook answered with status %d"
+                            % result.status_code)
+    return result.status_code == 200
@@ -1,9 +1,6 @@
 """Github OAuth authentication"""
 
-import json
-import urllib.request, urllib.parse, urllib.error
-import httplib2
-import os
+import logging
 
 from flask import request, \
                   session as login_session, \
@@ -13,8 +10,12 @@ from flask import request, \
 
 from pemoi import app
 from .pmoi_auth import get_user_info, get_user_id
+from .pmoi_user_cache import invalidate_user
 from .pmoi_db_session import db_session
-from config import _basedir
+from .pmoi_oauth import load_secrets, provider_url, call, fetch_all, \
+                        ProviderError
+
+log = logging.getLogger(__name__)
 
 
 # Connect with github
@@ -22,7 +23,7 @@ from config import _basedir
 def githubconnect():
     """Connect with github OAuth API"""
 
-    print("Github info incoming!")
+    log.debug("Github callback received")
     # Receive state from github
     state = request.args.get('state')
     # If state is not identical to db_session state, return error
@@ -31,51 +32,47 @@ def githubconnect():
         return redirect(url_for('login'))
     # Code is received from github
     code = request.args.get('code')
-    print("We've got a code: %s" % code)
-    # Load client id and secret from file
-    json_file = os.path.join(_basedir, 'github_client_secrets.json')
-    client_id = json.loads(open(json_file, 'r').read())['web']['client_id']
-    client_secret = json.loads(open(json_file, 'r').read())['web']['client_secret']
-    print("We've got client id and secret: %s, %s" % (client_id, client_secret))
+    # Client id and secret are read from file once
+    secrets = load_secrets('github')
     # Get parameters ready for requesting access token
-    params = {'code': code, 'client_id': client_id, 'client_secret': client_secret, 'state':state}
+    params = {'code': code, 'client_id': secrets['client_id'],
+              'client_secret': secrets['client_secret'], 'state':state}
     # Set headers to receive json encoded data
     headers = {'Accept':'application/json'}
-    url = 'https://github.com/login/oauth/access_token'
-    # Get response with access_token or error from github
-    h = httplib2.Http()
-    response = h.request(url, 'POST', urllib.parse.urlencode(params), headers=headers)
-    print(" Response: ", response)
-    # Read the actual result from the response
-    result = json.loads(response[1])
-    # Let the user know if there was an error
-    if 'error' in result:
-        flash("There was a problem: %s" % result['error'])
-        return redirect('login')
-    # get the access token
-    access_token = result['access_token']
-    #prepare headers with token
-    headers = {'Authorization': 'token %s' % access_token}
-    # get user data with access_token
-    url = 'https://api.github.com/user'
-    response, content = h.request(url, 'GET', headers=headers)
-    status = response.status
-    if status != 200:
-        return "There was a problem %s" % json.loads(content)['message']
-    result = json.loads(content)
+    url = provider_url('github', '/login/oauth/access_token')
+    try:
+        # Get response with access_token or error from github
+        response = call('POST', url, data=params, headers=headers)
+        # Read the actual result from the response
+        result = response.json()
+        # Let the user know if there was an error
+        if 'error' in result:
+            flash("There was a problem: %s" % result['error'])
+            return redirect('login')
+        # get the access token
+        access_token = result['access_token']
+        #prepare headers with token
+        headers = {'Authorization': 'token %s' % access_token}
+        # get user data and e-mail addresses with access_token
+        user_response, emails_response = fetch_all(
+            ('GET', provider_url('github_api', '/user'),
+             {'headers': headers}),
+            ('GET', provider_url('github_api', '/user/emails'),
+             {'headers': headers}))
+    except ProviderError:
+        flash("github can not be reached right now, please try again")
+        return redirect(url_for('login'))
+    for response in (user_response, emails_response):
+        if response.status_code != 200:
+            return "There was a problem %s" % response.json()['message']
+    result = user_response.json()
     # Store user data in session
     login_session['provider'] = 'Github'
     login_session['name'] = result['name']
     login_session['picture'] = result['avatar_url']
     login_session['access_token'] = access_token
-    # get user e-mail with access_token
-    url = 'https://api.github.com/user/emails'
-    response, content = h.request(url, 'GET', headers=headers)
-    status = response.status
-    if status != 200:
-        return "There was a problem %s" % json.loads(content)['message']
     # get list of non public e-mail addresses and store them in session
-    emails = json.loads(content)
+    emails = emails_response.json()
     email_addresses = [e['email'] for e in emails]
     login_session['emails'] = email_addresses
     # Check if user exists in db
@@ -90,6 +87,7 @@ def githubconnect():
             user.picture = login_session['picture']
             db_session.add(user)
             db_session.commit()
+            invalidate_user(user)
             flash("Thanks for logging in, %s" % login_session['username'])
             return redirect(url_for('index'))
     # If user doesn't exist, redirect to complete signup
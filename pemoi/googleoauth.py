@@ -1,11 +1,7 @@
 """Google OAuth authentication"""
 
-import os
-import requests
+import base64
 import json
-import httplib2
-
-from oauth2client.client import flow_from_clientsecrets, FlowExchangeError
 
 from flask import request, \
                   flash, \
@@ -13,37 +9,46 @@ from flask import request, \
 
 from pemoi import app
 from .pmoi_helpers import json_response, make_response
-from config import _basedir
+from .pmoi_oauth import load_secrets, provider_url, call, fetch_all, \
+                        ProviderError
 from . import pmoi_auth
 
 # Connect with Google+
 @app.route('/gconnect', methods=['POST'])
 def gconnect():
     """Connect with Google Oauth API"""
-
-    # Load JSON file form base directory
-    json_file = os.path.join(_basedir, 'google_client_secrets.json')
-    CLIENT_ID = json.loads(open(json_file,'r').read())['web']['client_id']
+    secrets = load_secrets('google')
+    CLIENT_ID = secrets['client_id']
     if request.args.get('state') != login_session['state']:
         response = "Invalid STATE parameter"
         return json_response(response, 401)
     # Obtain auth code
     code = request.data
     try:
-        # Upgrade the auth code into a credentials object
-        oauth_flow = flow_from_clientsecrets(json_file, scope='')
-        oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(code)
-    except FlowExchangeError:
-        response = 'Failed to upgrade the auth code to credentials object'
-        return json_response(response, 401)
-
-    # Check that access token is valid
-    access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s'
-           % access_token)
-    h = httplib2.Http()
-    result = json.loads(h.request(url, 'GET')[1])
+        # Upgrade the auth code into an access token and an ID token
+        answer = call('POST', provider_url('google_token'),
+                      data={'code': code,
+                            'client_id': CLIENT_ID,
+                            'client_secret': secrets['client_secret'],
+                            'redirect_uri': 'postmessage',
+                            'grant_type': 'authorization_code'})
+        credentials = answer.json() if answer.status_code == 200 else {}
+        access_token = credentials.get('access_token')
+        gplus_id = id_token_subject(credentials.get('id_token'))
+        if not access_token or not gplus_id:
+            response = 'Failed to upgrade the auth code to credentials object'
+            return json_response(response, 401)
+
+        # Check that access token is valid and get user information at the
+        # same time. The information is only used if the token checks out.
+        tokeninfo, userinfo = fetch_all(
+            ('GET', provider_url('google_api', '/oauth2/v1/tokeninfo'),
+             {'params': {'access_token': access_token}}),
+            ('GET', provider_url('google_api', '/oauth2/v1/userinfo'),
+             {'params': {'access_token': access_token, 'alt': 'json'}}))
+    except ProviderError:
+        return json_response("Google can not be reached right now", 504)
+    result = tokeninfo.json()
 
     # If there is an error in the result, abort mission
     if result.get('error') is not None:
@@ -51,7 +56,6 @@ def gconnect():
         return json_response(response, 500)
 
     # Verify that the token is for this user
-    gplus_id = credentials.id_token['sub']
     if result['user_id'] != gplus_id:
         response = 'User ID in token does not match user id'
         return json_response(response, 401)
@@ -70,16 +74,11 @@ def gconnect():
         response.headers['Content-Type'] = 'application/json'
 
     # Store credentials for usage
-    login_session['access_token'] = credentials.access_token
+    login_session['access_token'] = access_token
     login_session['gplus_id'] = gplus_id
 
-    # Get user Information
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    answer = requests.get(userinfo_url, params=params)
-
     # Receive user information from google's api
-    data = answer.json()
+    data = userinfo.json()
 
     # Store interesting stuff in my db_session
     login_session['provider'] = 'Google'
@@ -107,11 +106,40 @@ def gdisconnect():
         response = 'No user connected'
         return json_response(response, 401)
     # Revoke current token by http get request
-    url = 'https://accounts.google.com/o/oauth2/revoke?token=%s' % access_token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
+    try:
+        revoked = revoke_google(access_token)
+    except ProviderError:
+        return json_response("Google can not be reached right now", 504)
 
-    if result['status'] != '200':
+    if not revoked:
         # If token was invalid
         response = "Failed to revoke token for given user"
         return json_response(response, 400)
+    return json_response("Successfully disconnected", 200)
+
+def revoke_google(access_token):
+    """Revoke a Google access token.
+
+    Return: Boolean, False if Google refused, e.g. for an invalid token.
+    Raises ProviderError if Google can't be reached or has a problem, so
+    that the revocation can be tried again later.
+    """
+    result = call('GET', provider_url('google_accounts', '/o/oauth2/revoke'),
+                  params={'token': access_token})
+    if result.status_code >= 500:
+        raise ProviderError("Google answered with status %d"
+                            % result.status_code)
+    return result.status_code == 200
+
+def id_token_subject(id_token):
+    """Return the user ID ('sub') from a Google ID token, or None.
+
+    The token comes straight from Google's token endpoint, its signature is
+    not checked. The access token is verified with tokeninfo instead.
+    """
+    try:
+        payload = id_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))['sub']
+    except (AttributeError, IndexError, KeyError, ValueError):
+        return None
@@ -0,0 +1,153 @@
+"""Versioned JSON API, version 1.
+
+All list endpoints are paginated: 'limit' sets the page size (up to
+MAX_ITEMS_PER_PAGE) and the 'next' value of a response is passed as
+'cursor' to get the following page. 'fields' selects a comma separated
+subset of the fields of a resource; only those columns are loaded.
+
+Rows that the viewer may not see are filtered out by the queries: public
+rows and the logged in user's own rows are returned, nothing else.
+
+Endpoints:
+/api/v1/categories/                  Visible categories, by id
+/api/v1/categories/<id>/items/       Visible items of a category, newest first
+/api/v1/items/<id>/                  A single item
+/api/v1/items/?ids=1,2,3             Several items at once (also /items/json/)
+"""
+
+from flask import request, \
+                  session as login_session, \
+                  jsonify
+from sqlalchemy.orm import load_only
+
+from pemoi import app
+from .database_setup import Category, Item
+from .pmoi_db_session import db_session
+from .pmoi_helpers import json_response, keyset_page, page_size, \
+                          encode_key, decode_key
+
+API_PREFIX = '/api/v1'
+CATEGORY_FIELDS = ('id', 'name', 'description', 'user_id', 'public',
+                   'add_date')
+ITEM_FIELDS = ('id', 'link', 'thumb_link', 'title', 'artist', 'note',
+               'keywords', 'category_id', 'user_id', 'public', 'add_date',
+               'edit_date')
+
+
+class APIError(Exception):
+    """Error that is returned to the API client as JSON."""
+    def __init__(self, message, code=400):
+        Exception.__init__(self, message)
+        self.message = message
+        self.code = code
+
+@app.errorhandler(APIError)
+def api_error(error):
+    return json_response(error.message, error.code)
+
+
+def selected_fields(allowed):
+    """Return the fields requested with 'fields', all allowed ones by default.
+
+    Raises APIError for unknown fields.
+    """
+    requested = request.args.get('fields')
+    if not requested:
+        return allowed
+    fields = tuple(f.strip() for f in requested.split(',') if f.strip())
+    unknown = set(fields) - set(allowed)
+    if unknown:
+        raise APIError("Unknown fields: %s" % ', '.join(sorted(unknown)))
+    return fields
+
+def to_dict(obj, fields):
+    """Serialize the given fields of a model object, dates in ISO format."""
+    data = {}
+    for field in fields:
+        value = getattr(obj, field)
+        if hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        data[field] = value
+    return data
+
+def visible_categories(user_id):
+    """Criterion for categories that a user may see."""
+    return (Category.public==True) | (Category.user_id==user_id)
+
+def visible_items(user_id):
+    """Criterion for items that a user may see."""
+    return (Item.public==True) | (Item.user_id==user_id)
+
+
+@app.route(API_PREFIX + '/categories/')
+def api_categories():
+    """Return one page of visible categories, ordered by id"""
+    fields = selected_fields(CATEGORY_FIELDS)
+    query = db_session.query(Category)\
+                      .options(load_only(*set(fields) | {'id'}))\
+                      .filter(visible_categories(login_session.get('user_id')))
+    key = decode_key(request.args.get('cursor'), int)
+    if key:
+        query = query.filter(Category.id > key[0])
+    size = page_size(request.args.get('limit'))
+    categories = query.order_by(Category.id).limit(size + 1).all()
+    next_cursor = None
+    if len(categories) > size:
+        categories = categories[:size]
+        next_cursor = encode_key(categories[-1].id)
+    return jsonify(Categories=[to_dict(c, fields) for c in categories],
+                   next=next_cursor)
+
+@app.route(API_PREFIX + '/categories/<int:category_id>/items/')
+def api_category_items(category_id):
+    """Return one page of a category's visible items, newest first"""
+    user_id = login_session.get('user_id')
+    visible = db_session.query(Category.id)\
+                        .filter(Category.id==category_id,
+                                visible_categories(user_id)).first()
+    if not visible:
+        raise APIError("Category does not exist or is private", 404)
+    fields = selected_fields(ITEM_FIELDS)
+    query = db_session.query(Item)\
+                      .options(load_only(*set(fields) | {'id', 'add_date'}))\
+                      .filter(Item.category_id==category_id,
+                              visible_items(user_id))
+    items, next_cursor = keyset_page(query, Item,
+                                     request.args.get('cursor'),
+                                     page_size(request.args.get('limit')))
+    return jsonify(Items=[to_dict(i, fields) for i in items],
+                   next=next_cursor)
+
+@app.route(API_PREFIX + '/items/<int:item_id>/')
+def api_item(item_id):
+    """Return a single visible item"""
+    fields = selected_fields(ITEM_FIELDS)
+    item = db_session.query(Item)\
+                     .options(load_only(*set(fields) | {'id'}))\
+                     .filter(Item.id==item_id,
+                             visible_items(login_session.get('user_id')))\
+                     .first()
+    if item is None:
+        raise APIError("Item does not exist or is private", 404)
+    return jsonify(Item=to_dict(item, fields))
+
+@app.route('/items/json/')
+@app.route(API_PREFIX + '/items/')
+def api_items():
+    """Return several visible items by id, in the requested order"""
+    try:
+        ids = [int(i) for i in request.args.get('ids', '').split(',') if i]
+    except ValueError:
+        raise APIError("ids must be a comma separated list of item ids")
+    if len(ids) > page_size(len(ids) or None):
+        raise APIError("At most %d ids per request" % page_size(len(ids)))
+    fields = selected_fields(ITEM_FIELDS)
+    items = {}
+    if ids:
+        query = db_session.query(Item)\
+                          .options(load_only(*set(fields) | {'id'}))\
+                          .filter(Item.id.in_(ids),
+                                  visible_items(login_session.get('user_id')))
+        items = dict((i.id, i) for i in query)
+    return jsonify(Items=[to_dict(items[i], fields) for i in ids
+                          if i in items])
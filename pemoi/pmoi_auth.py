@@ -1,5 +1,6 @@
 """Handle Authentication, login, logout and complete signup routes."""
-import os
+
+import logging
 
 from flask import session as login_session, \
                   render_template, \
@@ -13,9 +14,15 @@ from .pmoi_helpers import make_state
 from .pmoi_db_session import db_session
 from .pmoi_helpers import username_error
 from .database_setup import User
-from .googleoauth import gdisconnect
-from .fboauth import fbdisconnect
-from config import UPLOAD_FOLDER, URL_INSERT
+from .pmoi_user_cache import find_user, invalidate_user
+from .googleoauth import revoke_google
+from .fboauth import revoke_facebook
+from .pmoi_jobs import job_handler, enqueue
+from config import URL_INSERT
+
+log = logging.getLogger(__name__)
+
+REVOKE_ATTEMPTS = app.config.get('OAUTH_REVOKE_ATTEMPTS', 5)
 
 
 # Create user entry
@@ -32,6 +39,8 @@ def create_user():
     db_session.add(user)
     db_session.commit()
     db_session.refresh(user)
+    # Lookups in this request may have missed the new user
+    invalidate_user(user)
     return user.id
 
 # Get user id by email
@@ -40,11 +49,8 @@ def get_user_id(email):
 
     Return user ID or None.
     """
-    try:
-        user = db_session.query(User).filter_by(email=email).one()
-        return user.id
-    except:
-        return None
+    user = find_user('email', email)
+    return user.id if user else None
 
 # Get user info
 def get_user_info(user_id):
@@ -52,11 +58,7 @@ def get_user_info(user_id):
 
     Return user object or None.
     """
-    try:
-        user = db_session.query(User).filter_by(id=user_id).one()
-        return user
-    except:
-        return None
+    return find_user('id', user_id)
 
 # Login page, creates state
 @app.route('/login/', methods=['GET', 'POST'])
@@ -85,19 +87,15 @@ def complete_signup():
         if 'email' in request.form:
             login_session['email'] = request.form['email']
         if not username_error(username):
-            print(username)
             login_session['username'] = username
             login_session['about'] = about
             # Create user in db and receive new user ID
             user_id = create_user()
             # Store user ID in session
             login_session['user_id'] = user_id
-            # Finally, if everything is okay, create a user directory for uploads
-            try:
-                os.mkdir(os.path.join(UPLOAD_FOLDER, username))
-                print("Created user directory successfully")
-            except Exception as e:
-                print(e, "Could not create user directory")
+            log.info("New user %s", username,
+                     extra={'user_id': user_id,
+                            'provider': login_session.get('provider')})
             flash("Welcome to your Personal Museum of Inspiration, %s" % login_session['username'])
             return redirect(url_for('index'))
 
@@ -108,15 +106,40 @@ def complete_signup():
 def logout():
     """Logout function."""
 
-    provider = login_session['provider']
-    if provider == 'Google':
-        gdisconnect()
-    elif provider == 'Facebook':
-        fbdisconnect()
+    queue_revocation()
     login_session.clear()
     flash("You have been logged out. Come back soon!")
     return redirect(url_for('index'))
 
+def queue_revocation():
+    """Queue revoking the logged in user's OAuth access at the provider.
+
+    The revocation runs in the background and is retried while the provider
+    is unavailable, so logging out doesn't wait for the provider.
+    """
+    provider = login_session.get('provider')
+    if provider == 'Google' and login_session.get('access_token'):
+        enqueue('revoke_oauth', max_attempts=REVOKE_ATTEMPTS,
+                provider=provider,
+                access_token=login_session['access_token'])
+    elif provider == 'Facebook' and login_session.get('facebook_id'):
+        enqueue('revoke_oauth', max_attempts=REVOKE_ATTEMPTS,
+                provider=provider,
+                access_token=login_session.get('access_token'),
+                facebook_id=login_session['facebook_id'])
+
+@job_handler('revoke_oauth')
+def revoke_oauth(provider, access_token, facebook_id=None):
+    """Background job: revoke OAuth access at the provider.
+
+    Raises ProviderError while the provider is unavailable, so the job is
+    retried. A refused revocation (e.g. an expired token) is not retried.
+    """
+    if provider == 'Google':
+        revoke_google(access_token)
+    elif provider == 'Facebook':
+        revoke_facebook(facebook_id, access_token)
+
 @app.route('/privacy/')
 def privacy():
     # TODO: Do privacy thingy
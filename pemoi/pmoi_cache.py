@@ -0,0 +1,153 @@
+"""Small caches shared across the site.
+
+Each worker process has its own caches. Entries expire after a TTL, so
+changes made through another worker become visible after at most that long;
+changes made through the same worker are invalidated explicitly.
+
+RedisCache has the same interface and is shared by all workers. It needs the
+optional redis package.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache():
+    """Thread-safe LRU cache with per-entry expiry.
+
+    Arguments: ttl in seconds (None for no expiry), maxsize as maximum number
+    of entries (None for unlimited). When full, the least recently used entry
+    is evicted.
+    """
+    def __init__(self, ttl=300, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return cached value for key, or default if missing or expired."""
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store value under key."""
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            if self.maxsize is not None:
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+
+    def get_or_set(self, key, create):
+        """Return cached value for key, calling create() to fill a miss."""
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = create()
+            self.set(key, value)
+        return value
+
+    def delete(self, key):
+        """Remove key from the cache if present."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_many(self, keys):
+        """Remove all given keys from the cache."""
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisCache():
+    """Cache stored in Redis and shared by all worker processes.
+
+    Values must be JSON serialisable. Redis errors are treated as misses, so
+    the site keeps working, uncached, if Redis is unavailable.
+
+    Arguments: url of the Redis server, e.g. 'redis://localhost:6379/0', ttl
+    in seconds (None for no expiry), prefix for all keys.
+    """
+    def __init__(self, url, ttl=300, prefix='pemoi:'):
+        # Optional dependency, only needed if a Redis cache is configured
+        import redis
+        self.ttl = ttl
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+        self._errors = redis.RedisError
+
+    def get(self, key, default=None):
+        """Return cached value for key, or default if missing."""
+        try:
+            value = self._redis.get(self.prefix + key)
+        except self._errors:
+            return default
+        if value is None:
+            return default
+        return json.loads(value)
+
+    def set(self, key, value):
+        """Store value under key."""
+        try:
+            self._redis.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+        except self._errors:
+            pass
+
+    def get_or_set(self, key, create):
+        """Return cached value for key, calling create() to fill a miss."""
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = create()
+            self.set(key, value)
+        return value
+
+    def delete(self, key):
+        """Remove key from the cache if present."""
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        """Remove all given keys from the cache."""
+        keys = [self.prefix + key for key in keys]
+        if not keys:
+            return
+        try:
+            self._redis.delete(*keys)
+        except self._errors:
+            pass
+
+    def clear(self):
+        """Remove all entries with this cache's prefix."""
+        try:
+            keys = list(self._redis.scan_iter(match=self.prefix + '*'))
+            if keys:
+                self._redis.delete(*keys)
+        except self._errors:
+            pass
+
+    def __len__(self):
+        try:
+            return sum(1 for _ in self._redis.scan_iter(match=self.prefix + '*'))
+        except self._errors:
+            return 0
@@ -1,5 +1,7 @@
 """Module to handle all things category."""
 
+from collections import namedtuple
+
 from flask import flash, \
                   render_template, \
                   redirect, \
@@ -7,12 +9,34 @@ from flask import flash, \
                   url_for, \
                   session as login_session, \
                   jsonify
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only
 
-from .database_setup import Category, Item
-from .pmoi_db_session import db_session
+from .database_setup import Category, Item, User
+from .pmoi_db_session import db_session, engine
+from .database_migrations import CATEGORY_COUNT_DDL
+from .pmoi_listing import item_listing_page
+from .pmoi_cache import TTLCache
+from .pmoi_helpers import keyset_page, page_size, conditional_response
 from pemoi import app
 from config import URL_INSERT
 
+# Lightweight, session independent copy of a category for the menu
+MenuCategory = namedtuple('MenuCategory',
+                          ['id', 'name', 'description', 'user_id', 'public',
+                           'item_count', 'public_item_count'])
+
+# Shared list of public categories under the key None, private categories
+# under the owner's user ID.
+menu_cache = TTLCache(ttl=app.config.get('CATEGORY_MENU_TTL', 300),
+                      maxsize=app.config.get('CATEGORY_MENU_MAX_USERS', 10000))
+
+# Item counts are only maintained by triggers on some databases, see
+# database_migrations. Like the menu, counts may lag by CATEGORY_MENU_TTL.
+CATEGORY_COUNTS = engine.dialect.name in CATEGORY_COUNT_DDL
+app.jinja_env.globals['CATEGORY_COUNTS'] = CATEGORY_COUNTS
+
 ### Helpers for categories
 
 # Check category name
@@ -35,7 +59,6 @@ def name_exists(name, id=-1):
 def get_categories(only_own=False):
     """Get categories from database.
 
-    Gets passed as context_processor for use in menu and otherwise.
     Returns: List of Category objects. Categories are public, public and private
     or only own. Categories must have id > 0 because category with ID 0 is the
     "No Category" catchall.
@@ -55,17 +78,101 @@ def get_categories(only_own=False):
                            ).all()
 
 
+def _menu_categories(*criterion):
+    """Query categories for the menu and copy them into MenuCategory tuples."""
+    return [MenuCategory(c.id, c.name, c.description, c.user_id, c.public,
+                         c.item_count, c.public_item_count)
+            for c in db_session.query(Category).filter(Category.id > 0,
+                                                       *criterion)\
+                                               .order_by(Category.id)]
+
+def get_menu_categories():
+    """Get categories for the menu from the cache.
+
+    Gets passed as context_processor for use in menu and otherwise.
+    Returns: List of MenuCategory tuples, public categories and, if a user is
+    logged in, their private categories. Only a cold cache hits the database.
+    """
+    public = menu_cache.get_or_set(None, lambda: _menu_categories(
+                                   Category.public==True))
+    user_id = login_session.get('user_id')
+    if not user_id:
+        return public
+    private = menu_cache.get_or_set(user_id, lambda: _menu_categories(
+                                    Category.public==False,
+                                    Category.user_id==user_id))
+    return sorted(public + private, key=lambda c: c.id)
+
+def invalidate_category_menu(user_id=None, public=True):
+    """Drop cached menu categories after categories have changed.
+
+    Arguments: user_id whose private categories changed (optional), public
+    as Boolean, whether the shared list of public categories changed.
+    """
+    if public:
+        menu_cache.delete(None)
+    if user_id is not None:
+        menu_cache.delete(user_id)
+
+def in_public_menu_count(item):
+    """Return True if the item is counted in the shared public menu.
+
+    Only then does adding, changing or deleting the item change the public
+    menu, see invalidate_category_menu.
+    """
+    return CATEGORY_COUNTS and item.public and item.category is not None \
+           and item.category.public
+
 # JSON endpoints
+def items_version(*criterion):
+    """Return count, latest change and owners of the items matching the
+    criterion.
+
+    Used as the version of item listings: adding, editing, moving or deleting
+    an item changes at least one of the values, and so does an owner changing
+    the username or picture shown with the items. The latest change alone
+    does not cover deletions, so listings are not sent with Last-Modified.
+    Return: Tuple (count, latest change as datetime or None, tuple of the
+    owners' (username, picture)).
+    """
+    rows = db_session.query(User.username, User.picture,
+                            func.count(Item.id),
+                            func.max(func.coalesce(Item.edit_date,
+                                                   Item.add_date)))\
+                     .select_from(Item)\
+                     .outerjoin(User, Item.user_id==User.id)\
+                     .filter(*criterion)\
+                     .group_by(User.id, User.username, User.picture)\
+                     .order_by(User.id).all()
+    count = sum(row[2] for row in rows)
+    latest = max((row[3] for row in rows if row[3] is not None), default=None)
+    return count, latest, tuple((row[0], row[1]) for row in rows)
+
 @app.route('/category/<int:category_id>/json/')
 def category_json(category_id):
-    """Return a category in JSON format"""
-    items = db_session.query(Item).filter_by(category_id=category_id).all()
-    return jsonify(CategoryItems = [i.serialize for i in items])
+    """Return one page of a category's public items in JSON format"""
+    criterion = (Item.category_id==category_id, Item.public==True)
+    count, latest, _ = items_version(*criterion)
+
+    def render():
+        query = db_session.query(Item).filter(*criterion)
+        items, next_cursor = keyset_page(query, Item,
+                                         request.args.get('cursor'),
+                                         page_size(request.args.get('limit')))
+        return jsonify(CategoryItems = [i.serialize for i in items],
+                       next = next_cursor)
+    return conditional_response(render,
+                                (category_id, count, latest),
+                                max_age=app.config.get('JSON_MAX_AGE', 60))
 
 @app.route('/categories/json/')
 def categories_json():
     """Return all public categories in JSON format"""
-    categories = db_session.query(Category).all()
+    categories = db_session.query(Category)\
+                           .options(load_only('name', 'description',
+                                              'add_date', 'public'))\
+                           .filter(Category.public==True)\
+                           .order_by(Category.id).all()
     return jsonify(Categories = [c.serialize for c in categories])
 
 # Routes
@@ -93,9 +200,11 @@ def show_own():
     if not 'user_id' in login_session:
         flash("Please log in to view your items")
         return redirect(url_for('login'))
-    items = db_session.query(Item).filter_by(user_id=login_session['user_id'])\
-            .all()
-    return render_template('index.html', items=items)
+    items, next_cursor = item_listing_page(
+                            Item.user_id==login_session['user_id'],
+                            request.args.get('cursor'),
+                            request.args.get('limit'))
+    return render_template('index.html', items=items, next_cursor=next_cursor)
 
 
 @app.route('/category/<int:category_id>/')
@@ -114,14 +223,22 @@ def show_category(category_id):
     if not (category.public or category.user_id == user_id):
         flash("Category does not exist or is private")
         return redirect(url_for('index'))
-    items = db_session.query(Item).filter(\
-                                (Item.category_id==category.id)\
-                                &((Item.public==True)\
-                                |(Item.user_id==user_id)))\
-                                .all()
-    return render_template('showcategory.html',
-                            category=category,
-                            items=items)
+    criterion = (Item.category_id==category.id)\
+                &((Item.public==True)|(Item.user_id==user_id))
+    count, latest, owners = items_version(criterion)
+
+    def render():
+        items, next_cursor = item_listing_page(criterion,
+                                               request.args.get('cursor'),
+                                               request.args.get('limit'))
+        return render_template('showcategory.html',
+                               category=category,
+                               items=items,
+                               next_cursor=next_cursor)
+    return conditional_response(render,
+                                (category.id, category.name,
+                                 category.description, category.user_id,
+                                 category.public, count, latest, owners))
 
 @app.route('/category/new/', methods=['GET', 'POST'])
 def new_category():
@@ -141,8 +258,15 @@ def new_category():
             return render_template('editcategory.html',
                                     category=category)
         db_session.add(category)
-        db_session.commit()
+        try:
+            db_session.commit()
+        except IntegrityError:
+            # Somebody else created the same public category meanwhile
+            db_session.rollback()
+            flash("Another public category of the same name already exists.")
+            return render_template('editcategory.html', category=category)
         db_session.refresh(category)
+        invalidate_category_menu(category.user_id, category.public)
         return redirect(url_for('show_category', category_id=category.id))
     else:
         return render_template('newcategory.html', BASE_URL=URL_INSERT)
@@ -175,7 +299,15 @@ def edit_category(category_id):
             category.name = name
             category.description = request.form['description']
             db_session.add(category)
-            db_session.commit()
+            try:
+                db_session.commit()
+            except IntegrityError:
+                # Somebody else created the same public category meanwhile
+                db_session.rollback()
+                flash("This public category already exists")
+                return render_template('editcategory.html', category=category)
+            # The category may have been switched between public and private
+            invalidate_category_menu(category.user_id)
             return redirect(url_for('category', category_id=category_id))
         else:
             return render_template('editcategory.html',
@@ -195,7 +327,7 @@ def delete_category(category_id):
     elif login_session['user_id'] != category.user_id:
         flash("You can only delete categories that you have created yourself")
         return redirect(url_for('category', category_id=category_id))
-    elif category.items:
+    elif not category.is_empty():
         flash("""This category has items in it. You can only delete an empty
               category (There may be private items in there)""")
         return redirect(url_for('show_category', category_id=category_id))
@@ -203,6 +335,7 @@ def delete_category(category_id):
         if request.method == 'POST':
             db_session.delete(category)
             db_session.commit()
+            invalidate_category_menu(category.user_id, category.public)
             return redirect(url_for('index'))
         else:
             return render_template('deletecategory.html',
@@ -0,0 +1,79 @@
+"""Command line interface. Run commands with `FLASK_APP=pemoi flask <command>`."""
+
+import os
+
+import click
+
+from pemoi import app
+from .database_setup import Item
+from .database_migrations import upgrade
+from .pmoi_db_session import engine, db_session
+from .pmoi_helpers import get_or_create_admin, get_or_create_cat_zero
+from .pmoi_jobs import work, enqueue
+from .pmoi_images import variant_filenames
+from .pmoi_storage import BLOB_DIR, upload_path, upload_url, move_to_store
+
+def bootstrap():
+    """Prepare the database for the app.
+
+    Applies pending schema migrations and makes sure that admin and category
+    0 exist. Safe to run repeatedly.
+    """
+    upgrade(engine)
+    get_or_create_admin()
+    get_or_create_cat_zero()
+    db_session.remove()
+
+@app.cli.command('bootstrap')
+def bootstrap_command():
+    """Migrate the database, create admin and category 0."""
+    bootstrap()
+    click.echo("Database is ready")
+
+@app.cli.command('worker')
+@click.option('--once', is_flag=True,
+              help="Exit when there are no more jobs to run.")
+@click.option('--poll', default=1.0,
+              help="Seconds to wait between checks of an empty queue.")
+def worker_command(once, poll):
+    """Run background jobs, e.g. processing of uploads."""
+    work(poll_interval=poll, once=once)
+
+@app.cli.command('migrate-uploads')
+def migrate_uploads_command():
+    """Move uploads from user directories into the content store."""
+    moved = 0
+    legacy = db_session.query(Item).filter(
+                 Item.link.like(upload_url('%')),
+                 ~Item.link.like(upload_url(BLOB_DIR + '/%')))
+    for item in legacy.all():
+        path = upload_path(item.link)
+        if path is None or not os.path.exists(path):
+            continue
+        stored = move_to_store(path)
+        if stored is None:
+            continue
+        directory = os.path.dirname(path)
+        for filename in variant_filenames(item):
+            try:
+                os.remove(os.path.join(directory, filename))
+            except OSError:
+                pass
+        path, item.link = stored
+        # Variants are recreated under the new name in the background
+        item.thumb_link = item.srcset = item.webp_srcset = None
+        item.status = 'processing'
+        db_session.add(item)
+        enqueue('process_upload', item_id=item.id, path=path)
+        moved += 1
+    db_session.remove()
+    click.echo("Moved %d uploads into the content store" % moved)
+
+@app.cli.command('backfill-tags')
+@click.option('--batch-size', default=500,
+              help="Number of items per transaction.")
+def backfill_tags_command(batch_size):
+    """Queue a job that creates tags from the keywords of existing items."""
+    enqueue('backfill_tags', batch_size=batch_size)
+    db_session.remove()
+    click.echo("Queued, run 'flask worker' to process the items")
@@ -1,10 +1,50 @@
-"""Database session for user across the site."""
+"""Database engine and session for use across the site.
+
+There is exactly one engine (and with it one connection pool) per process.
+The session is scoped to the request: it is removed when the application
+context is torn down at the end of every request, which returns its
+connection to the pool.
+"""
 
 from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from pemoi import app
 
-engine = create_engine(app.config['DB_URI'])
+def make_engine(config):
+    """Create the database engine from the app config.
+
+    Argument: Config mapping. DB_URI is required, the optional settings are
+        DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE (seconds),
+        DB_POOL_PRE_PING, DB_STATEMENT_TIMEOUT (milliseconds, PostgreSQL
+        only) and DB_ECHO (log all statements, for profiling).
+    Return: SQLAlchemy engine.
+    """
+    url = make_url(config['DB_URI'])
+    options = {
+        'echo': config.get('DB_ECHO', False),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+    }
+    if url.get_backend_name() != 'sqlite':
+        # SQLite uses its own pool classes, which do not accept sizing
+        options.update(
+            pool_size=config.get('DB_POOL_SIZE', 5),
+            max_overflow=config.get('DB_MAX_OVERFLOW', 10),
+            pool_recycle=config.get('DB_POOL_RECYCLE', 3600),
+        )
+    timeout = config.get('DB_STATEMENT_TIMEOUT')
+    if timeout and url.get_backend_name() == 'postgresql':
+        options['connect_args'] = {
+            'options': '-c statement_timeout=%d' % timeout
+        }
+    return create_engine(url, **options)
+
+engine = make_engine(app.config)
 
 db_session = scoped_session(sessionmaker(bind=engine))
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    """Return the request's connection to the pool."""
+    db_session.remove()
@@ -0,0 +1,92 @@
+"""Cache for rendered item boxes.
+
+An item box only changes when the item, its category name or its owner's
+name or picture changes, and it differs for the owner (edit and delete
+links). Each item has one cache entry holding the version of the item it was
+rendered from and the HTML for owner and other viewers. A stale version is
+re-rendered and replaces the entry, so edits never show outdated boxes even
+if another worker made them; explicit invalidation frees the memory early.
+
+Set FRAGMENT_CACHE_URL to a Redis URL to share the cache between workers,
+otherwise every worker keeps its own LRU cache.
+"""
+
+import threading
+
+from flask import render_template, \
+                  session as login_session
+from markupsafe import Markup
+
+from pemoi import app
+from .pmoi_cache import TTLCache, RedisCache
+from .pmoi_helpers import make_etag
+
+FRAGMENT_CACHE_TTL = app.config.get('FRAGMENT_CACHE_TTL', 3600)
+
+def make_fragment_cache(config):
+    """Create the fragment cache configured in the app config."""
+    url = config.get('FRAGMENT_CACHE_URL')
+    if url:
+        return RedisCache(url, ttl=FRAGMENT_CACHE_TTL, prefix='pemoi:fragment:')
+    return TTLCache(ttl=FRAGMENT_CACHE_TTL,
+                    maxsize=config.get('FRAGMENT_CACHE_SIZE', 5000))
+
+fragment_cache = make_fragment_cache(app.config)
+
+# Hit and miss counters of this worker
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+def _count(result):
+    with _stats_lock:
+        _stats[result] += 1
+
+def fragment_stats():
+    """Return hits, misses and number of cached items of this worker."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['size'] = len(fragment_cache)
+    return stats
+
+def item_box_key(item_id):
+    return 'itembox:%d' % item_id
+
+def item_box_version(item):
+    """Return a version string for everything an item box shows."""
+    return make_etag(item.id, item.add_date, item.edit_date, item.status,
+                     item.category.name, item.user.username,
+                     item.user.picture)
+
+def item_box(item):
+    """Render itembox.html for an item, from the cache if possible.
+
+    Available in templates as item_box(item).
+    Argument: Item object with user and category.
+    Return: HTML as Markup.
+    """
+    # Keys of JSON objects are strings, also for the Redis cache
+    viewer = 'owner' if item.user_id == login_session.get('user_id') \
+             else 'other'
+    key = item_box_key(item.id)
+    version = item_box_version(item)
+    entry = fragment_cache.get(key)
+    if entry and entry['version'] == version and viewer in entry['html']:
+        _count('hits')
+        return Markup(entry['html'][viewer])
+    _count('misses')
+    html = render_template('itembox.html', item=item)
+    rendered = {}
+    if entry and entry['version'] == version:
+        rendered.update(entry['html'])
+    rendered[viewer] = html
+    fragment_cache.set(key, {'version': version, 'html': rendered})
+    return Markup(html)
+
+app.jinja_env.globals['item_box'] = item_box
+
+def invalidate_item_boxes(item_ids):
+    """Drop the cached boxes of the given items.
+
+    Argument: Iterable of item IDs.
+    """
+    fragment_cache.delete_many([item_box_key(i) for i in item_ids])
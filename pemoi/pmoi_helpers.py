@@ -4,11 +4,23 @@ import random
 import string
 import json
 import re
+import base64
+import hashlib
+import logging
+from datetime import datetime, timezone
 
-from flask import make_response
+from flask import make_response, \
+                  request, \
+                  session as login_session
+from sqlalchemy import and_, or_, desc, func
+from sqlalchemy.orm import aliased
 from sqlalchemy.orm.exc import NoResultFound
+from pemoi import app
 from .pmoi_db_session import db_session
 from .database_setup import User, Category
+from .pmoi_user_cache import find_user
+
+log = logging.getLogger(__name__)
 
 FORBIDDEN_USER = ['static', 'user', 'admin', 'administrator', 'moderator']
 
@@ -24,6 +36,177 @@ def json_response(response_string, code):
     response.headers['Content-Type'] = 'application/json'
     return response
 
+# Keyset pagination
+def encode_cursor(item):
+    """Create an opaque pagination cursor from an item's sort key.
+
+    Argument: Item object (last item of a page).
+    Return: URL-safe string encoding add_date and id.
+    """
+    key = "%s|%d" % (item.add_date.isoformat(), item.id)
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+def decode_cursor(cursor):
+    """Decode a pagination cursor created by encode_cursor.
+
+    Argument: Cursor as string.
+    Return: Tuple (add_date, id) or None if the cursor is missing or invalid.
+    """
+    if not cursor:
+        return None
+    try:
+        key = base64.urlsafe_b64decode(cursor.encode()).decode()
+        add_date, item_id = key.rsplit('|', 1)
+        return datetime.fromisoformat(add_date), int(item_id)
+    except (ValueError, TypeError):
+        return None
+
+def encode_key(*values):
+    """Create an opaque pagination cursor from JSON serialisable values."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_key(cursor, *types):
+    """Decode a cursor created by encode_key.
+
+    Arguments: Cursor as string, one type (e.g. int, float) per value.
+    Return: Tuple of values converted to types, or None if the cursor is
+        missing or invalid.
+    """
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(values) != len(types):
+            return None
+        return tuple(t(v) for t, v in zip(types, values))
+    except (ValueError, TypeError):
+        return None
+
+def keyset_page(query, model, cursor=None, page_size=30):
+    """Fetch one page of a query, newest first, using keyset pagination.
+
+    Rows are ordered by (add_date, id) descending. Instead of an OFFSET, the
+    page starts right after the row the cursor points to, so every page costs
+    the same, no matter how deep into the result set it is.
+
+    Arguments: SQLAlchemy query, mapped class with add_date and id columns,
+        cursor as string (optional), page_size as int (optional).
+    Return: Tuple (list of objects, cursor for the next page or None).
+    """
+    key = decode_cursor(cursor)
+    if key:
+        add_date, last_id = key
+        # Compare against the stored value of the last row (a primary key
+        # lookup), so that the database's own date format is used. The date
+        # from the cursor is only a fallback in case that row was deleted.
+        last = aliased(model)
+        anchor = func.coalesce(query.session.query(last.add_date)
+                                    .filter(last.id==last_id).as_scalar(),
+                               add_date)
+        query = query.filter(or_(model.add_date < anchor,
+                                 and_(model.add_date == anchor,
+                                      model.id < last_id)))
+    rows = query.order_by(desc(model.add_date), desc(model.id))\
+                .limit(page_size + 1).all()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(rows[-1])
+    return rows, next_cursor
+
+def page_size(requested=None):
+    """Return the number of items per page.
+
+    Argument: Requested page size (optional), e.g. from the query string.
+    Return: Integer between 1 and the configured MAX_ITEMS_PER_PAGE.
+    """
+    default = app.config.get('ITEMS_PER_PAGE', 30)
+    maximum = app.config.get('MAX_ITEMS_PER_PAGE', 100)
+    try:
+        size = int(requested) if requested else default
+    except ValueError:
+        size = default
+    return max(1, min(size, maximum))
+
+# Conditional requests
+def make_etag(*parts):
+    """Create an entity tag from values that identify a version of a page.
+
+    Arguments: Any number of values with a stable repr (ids, dates, ...).
+    Return: Hex digest as string.
+    """
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+def http_datetime(*dates):
+    """Return the latest of the given dates as naive UTC, whole seconds.
+
+    HTTP dates have a resolution of one second. Missing dates are ignored,
+    None is returned if there is no date at all.
+    """
+    dates = [d for d in dates if d is not None]
+    if not dates:
+        return None
+    normalised = []
+    for date in dates:
+        if isinstance(date, str):
+            date = datetime.fromisoformat(date)
+        if date.tzinfo is not None:
+            date = date.astimezone(timezone.utc).replace(tzinfo=None)
+        normalised.append(date.replace(microsecond=0))
+    return max(normalised)
+
+def is_fresh(etag, last_modified=None):
+    """Check whether the client's cached copy matches the current version.
+
+    If-None-Match takes precedence over If-Modified-Since. Only GET and HEAD
+    requests are answered from the client's copy.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if last_modified and request.if_modified_since:
+        return last_modified <= http_datetime(request.if_modified_since)
+    return False
+
+def conditional_response(render, version, last_modified=None, max_age=None):
+    """Return 304 Not Modified if the client's copy is current, else render.
+
+    Arguments:
+    render: Callable returning the full response, only called when needed
+    version: Tuple of values that change whenever the response changes
+    last_modified: Datetime of the latest change, if known
+    max_age: Seconds that any cache may reuse the response without asking.
+    If None, the response depends on the logged in user: it is private and
+    revalidated on every request, and the version includes the user and the
+    category menu.
+    """
+    private = max_age is None
+    if private:
+        # Imported here, pmoi_cat depends on this module
+        from .pmoi_cat import get_menu_categories
+        version = tuple(version) + (login_session.get('user_id'),
+                                    login_session.get('username'),
+                                    get_menu_categories())
+    etag = make_etag(*version)
+    last_modified = http_datetime(last_modified)
+    # Pending flash messages are only shown in a freshly rendered page.
+    if is_fresh(etag, last_modified) and '_flashes' not in login_session:
+        response = app.response_class(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    if private:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response
+
 # Generate a state for oauth
 def make_state():
     """Create state parameter for OAuth.
@@ -51,7 +234,7 @@ def username_error(username):
                Alphanumeric and '.', '_' or '-' only.""" % username
     if get_user_by_username(username):
         return "Username %s is already taken" % username
-    print("Username checks out")
+    log.debug("Username %s checks out", username)
     return None
 
 # Get user by username
@@ -61,11 +244,7 @@ def get_user_by_username(username):
     Argument: Username as string.
     Return: User object or None.
     """
-    try:
-        user = db_session.query(User).filter_by(username=username).one()
-        return user
-    except NoResultFound as err:
-        return None
+    return find_user('username', username)
 
 # make sure link is an image
 def check_img_link(link):
@@ -90,10 +269,8 @@ def get_or_create_cat_zero():
     """
     try:
         cat_zero = db_session.query(Category).filter_by(id=0).one()
-        print("Found cat_zero, continue")
         return cat_zero
     except NoResultFound:
-        print("Category not found, creating cat_zero")
         cat_zero = Category(id=0,
                             name="No Category",
                             description="Catchall category for uncategorised \
@@ -102,7 +279,7 @@ def get_or_create_cat_zero():
                             public=True)
         db_session.add(cat_zero)
         db_session.commit()
-        print("cat_zero added")
+        log.info("Created category 0")
         return cat_zero
 
 def get_or_create_admin():
@@ -114,10 +291,8 @@ def get_or_create_admin():
     """
     try:
         admin = db_session.query(User).filter_by(id=0).one()
-        print("Admin account exists, show page normally")
         return admin
     except NoResultFound:
-        print("No admin found, cerating admin account")
         admin = User(id=0,
                      name="Admin",
                      username="Admin",
@@ -126,5 +301,5 @@ def get_or_create_admin():
                      picture="/static/users/admin.jpg")
         db_session.add(admin)
         db_session.commit()
-        print("Admin created")
+        log.info("Created admin account")
         return admin
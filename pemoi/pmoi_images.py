@@ -0,0 +1,99 @@
+"""Resized variants of uploaded images.
+
+Originals are stored as uploaded. Next to each original, smaller variants
+(and optionally WebP copies) are written, so that item grids can serve an
+image that fits the screen instead of the full-size upload. Pillow is only
+imported when an image is actually processed.
+"""
+
+import os
+
+from pemoi import app
+
+# Variant name and maximum width in pixels, smallest first
+IMAGE_VARIANTS = app.config.get('IMAGE_VARIANTS',
+                                (('thumb', 320), ('medium', 960)))
+# Also write WebP copies of the original and all variants
+IMAGE_WEBP = app.config.get('IMAGE_WEBP', False)
+# Rendered width of images in item grids, for the 'sizes' attribute
+IMAGE_SIZES = app.config.get('IMAGE_SIZES', '(min-width: 1200px) 1140px, 100vw')
+app.jinja_env.globals['IMAGE_SIZES'] = IMAGE_SIZES
+
+def variant_filename(filename, variant, ext):
+    """Return the filename of a variant, e.g. 'cat.thumb.jpg' for 'cat.png'"""
+    return '%s.%s.%s' % (filename.rsplit('.', 1)[0], variant, ext)
+
+def _save(image, path, ext):
+    """Save a Pillow image, converting the mode if the format requires it."""
+    if ext == 'jpg':
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.save(path, 'JPEG', quality=85, optimize=True)
+    elif ext == 'webp':
+        image.save(path, 'WEBP', quality=80)
+    else:
+        image.save(path, 'PNG', optimize=True)
+
+def make_variants(path, url):
+    """Write resized variants for the image file at path.
+
+    Variants are only created for sizes smaller than the original. Images
+    with transparency are saved as PNG, all others as JPEG.
+
+    Arguments: path of the original, URL of the original (as in item.link).
+    Return: Dictionary with 'thumb_link' (smallest image for 'src'),
+        'srcset' and 'webp_srcset' (None if WebP is disabled), suitable as
+        Item column values. Empty if the file could not be read as image.
+    """
+    from PIL import Image, ImageOps
+    try:
+        original = Image.open(path)
+        original.load()
+    except (IOError, OSError):
+        return {}
+    if hasattr(ImageOps, 'exif_transpose'):
+        # Phone pictures are often stored rotated, with an EXIF hint
+        original = ImageOps.exif_transpose(original)
+    directory, filename = os.path.split(path)
+    base_url = url.rsplit('/', 1)[0]
+    alpha = original.mode in ('RGBA', 'LA') or \
+            (original.mode == 'P' and 'transparency' in original.info)
+    ext = 'png' if alpha else 'jpg'
+    width, height = original.size
+    srcset, webp_srcset = [], []
+    thumb_link = None
+    for variant, max_width in IMAGE_VARIANTS:
+        if max_width >= width:
+            break
+        resized = original.resize(
+            (max_width, max(1, round(height * max_width / width))),
+            Image.LANCZOS)
+        name = variant_filename(filename, variant, ext)
+        _save(resized, os.path.join(directory, name), ext)
+        srcset.append('%s/%s %dw' % (base_url, name, max_width))
+        thumb_link = thumb_link or '%s/%s' % (base_url, name)
+        if IMAGE_WEBP:
+            name = variant_filename(filename, variant, 'webp')
+            _save(resized, os.path.join(directory, name), 'webp')
+            webp_srcset.append('%s/%s %dw' % (base_url, name, max_width))
+    srcset.append('%s %dw' % (url, width))
+    if IMAGE_WEBP:
+        name = variant_filename(filename, 'full', 'webp')
+        _save(original, os.path.join(directory, name), 'webp')
+        webp_srcset.append('%s/%s %dw' % (base_url, name, width))
+    return {
+        'thumb_link': thumb_link,
+        'srcset': ', '.join(srcset),
+        'webp_srcset': ', '.join(webp_srcset) or None,
+    }
+
+def variant_filenames(item):
+    """Return the filenames of all variants stored for an item."""
+    names = set()
+    for srcset in (item.srcset, item.webp_srcset):
+        for candidate in (srcset or '').split(','):
+            if candidate.strip():
+                names.add(candidate.split()[0].rsplit('/', 1)[-1])
+    # The original is part of the srcset as well
+    names.discard(item.link.rsplit('/', 1)[-1])
+    return names
@@ -1,27 +1,40 @@
 """Index module. Render the index page."""
 
-from flask import session as login_session, \
-                  render_template
-
-from sqlalchemy import desc
+from flask import render_template, \
+                  request, \
+                  jsonify
 
 from pemoi import app
 from .database_setup import Item
-from .pmoi_db_session import db_session
+from .pmoi_listing import item_listing_page
+
+def get_index_page(cursor=None, limit=None):
+    """Get one page of public items for the front page, newest first.
+
+    Arguments: cursor as string (optional), requested page size (optional).
+    Return: Tuple (list of Item objects, cursor for the next page or None).
+    """
+    return item_listing_page(Item.public==True, cursor, limit)
 
 @app.route('/')
 @app.route('/index/')
 def index():
-    """Render index page with all public items.
+    """Render index page with one page of public items.
 
-    If user session exists, user's private items will be displayed as well.
+    The page is selected with the 'cursor' query parameter, which is provided
+    as link to the next page in the template.
     """
-    user_id = login_session.get("user_id")
     try:
-        items = db_session.query(Item).filter(\
-                                (Item.public==True) | ((Item.user_id==user_id) & Item.public==True)).\
-                                order_by(desc(Item.add_date)).all()
+        items, next_cursor = get_index_page(request.args.get('cursor'),
+                                            request.args.get('limit'))
     except:
         # Make sure that there is something to be passed to the template.
-        items = None
-    return render_template('index.html', items=items)
+        items, next_cursor = None, None
+    return render_template('index.html', items=items, next_cursor=next_cursor)
+
+@app.route('/index/json/')
+def index_json():
+    """Return one page of public items in JSON format"""
+    items, next_cursor = get_index_page(request.args.get('cursor'),
+                                        request.args.get('limit'))
+    return jsonify(Items=[i.serialize for i in items], next=next_cursor)
@@ -1,4 +1,5 @@
 """Module for all pages regarding items."""
+
 import os
 
 from flask import flash, \
@@ -9,51 +10,76 @@ from flask import flash, \
                   session as login_session, \
                   send_from_directory, \
                   jsonify
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
-from werkzeug.utils import secure_filename
 from pemoi import app
 from .database_setup import Item, Category
 from .pmoi_db_session import db_session
-from .pmoi_cat import name_exists
-from .pmoi_helpers import check_img_link
+from .pmoi_cat import name_exists, invalidate_category_menu, \
+                       in_public_menu_count
+from .pmoi_fragments import invalidate_item_boxes
+from .pmoi_helpers import check_img_link, json_response, \
+                          conditional_response
+from .pmoi_images import make_variants, variant_filenames
+from .pmoi_jobs import job_handler, enqueue
+from .pmoi_storage import store_upload, release_upload, release_uploads
+from .pmoi_tags import set_item_tags, delete_orphan_tags
 from config import URL_INSERT
 
-# set allowed extensions for upload
-ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
-
-def allowed_file(filename):
-    """Check if an uploaded file has allowed filetype.
-
-    Argument: Filename as string.
-    Return: Boolean
-    """
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
 
 # JSON endpoint for items
 @app.route('/inspiration/<int:item_id>/json/')
 def item_json(item_id):
     """Provide JSON endpoint for an individual item."""
-    item = db_session.query(Item).filter_by(id=item_id).one()
-    return jsonify(item.serialize)
+    item = db_session.query(Item).filter_by(id=item_id).first()
+    if item is None:
+        return json_response("This item does not exist", 404)
+    if not item.public:
+        # Only public items may be kept by shared caches
+        response = jsonify(item.serialize)
+        response.cache_control.private = True
+        response.cache_control.no_store = True
+        return response
+    return conditional_response(lambda: jsonify(item.serialize),
+                                item_version(item),
+                                last_modified=item_modified(item),
+                                max_age=app.config.get('JSON_MAX_AGE', 60))
 
 # Show an individual item
 @app.route('/inspiration/<int:item_id>/', methods=['GET', 'POST'])
 def show_item(item_id):
     """Show individual item."""
-    try:
-        item = db_session.query(Item).filter_by(id=item_id).one()
-    except:
+    item = db_session.query(Item).options(joinedload(Item.user),
+                                          joinedload(Item.category))\
+                                 .filter_by(id=item_id).first()
+    if item is None:
         flash("This item does not exist")
         return redirect(url_for('index'))
     # Make sure that user is authorised to see the item
     if item.public or item.user_id == login_session.get('user_id'):
-        return render_template('showitem.html', item=item)
+        # The page also shows the owner and the category name.
+        return conditional_response(
+                    lambda: render_template('showitem.html', item=item),
+                    item_version(item) + (item.user.username,
+                                          item.user.picture,
+                                          item.category.name),
+                    last_modified=item_modified(item))
     else:
         flash("This item is not public and belongs to somebody else.")
         return redirect(url_for('index'))
 
+def item_version(item):
+    """Return the values that change whenever an item changes.
+
+    edit_date is set on every update, including background processing.
+    """
+    return (item.id, item.add_date, item.edit_date, item.status)
+
+def item_modified(item):
+    """Return the date of an item's latest change."""
+    return item.edit_date or item.add_date
+
 # Create a new item
 @app.route('/inspiration/new/', methods=['GET', 'POST'])
 def new_item():
@@ -66,21 +92,13 @@ def new_item():
         return redirect(url_for('login'))
     if request.method == 'POST':
         link = ''
+        save_path = None
         file = request.files['file']
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            path = os.path.join(app.config['UPLOAD_FOLDER'],
-                                login_session['username'])
-            save_path = os.path.join(path, filename)
-            file.save(save_path)
-            link = url_for(
-                'static', 
-                filename=os.path.join(
-                    'users',
-                    login_session['username'],
-                    filename
-                )
-            )
+        # The upload has already been received into a temporary file, and
+        # its type has been checked by its content, see pmoi_storage.
+        stored = store_upload(file.stream) if file else None
+        if stored:
+            save_path, link, stored_before = stored
         # 'link' will be empty if no file was uploaded. In that case, the user
         # should provide an image link.
         if not link:
@@ -98,8 +116,17 @@ def new_item():
                                 user_id=login_session['user_id'],
                                 public=True if public else False)
             db_session.add(category)
-            db_session.commit()
+            try:
+                db_session.commit()
+            except IntegrityError:
+                # Somebody else created the same public category meanwhile
+                db_session.rollback()
+                flash("This public category exists already")
+                if save_path:
+                    release_upload(link)
+                return redirect(url_for('new_item'))
             db_session.refresh(category)
+            invalidate_category_menu(category.user_id, category.public)
             category_id = category.id
         else:
             # If no new category was provided, use the ID from the drop down.
@@ -118,15 +145,63 @@ def new_item():
                     user_id=login_session['user_id'],
                     public=True if request.form.get('public') else False
                     )
+        set_item_tags(item)
         db_session.add(item)
-        db_session.commit()
+        processed = None
+        if save_path and stored_before:
+            # Somebody uploaded the same image before, reuse its variants.
+            processed = db_session.query(Item).filter(Item.link==link,
+                                                      Item.status=='ready')\
+                                              .first()
+        if processed:
+            item.thumb_link = processed.thumb_link
+            item.srcset = processed.srcset
+            item.webp_srcset = processed.webp_srcset
+            db_session.commit()
+        elif save_path:
+            # Resizing happens in the background, the item is shown with a
+            # placeholder until then.
+            item.status = 'processing'
+            db_session.flush()
+            enqueue('process_upload', item_id=item.id, path=save_path)
+        else:
+            db_session.commit()
         db_session.refresh(item)
+        # The menu shows item counts
+        invalidate_category_menu(item.user_id, in_public_menu_count(item))
         flash("Inspiration successfully saved")
         return redirect(url_for('show_item', item_id=item.id))
     else:
         return render_template('newitem.html', BASE_URL=URL_INSERT)
 
 
+@job_handler('process_upload',
+             on_failure=lambda item_id, path: set_item_status(item_id,
+                                                              'failed'))
+def process_upload(item_id, path):
+    """Background job: write resized variants of an uploaded image.
+
+    Arguments: item_id as int, path of the uploaded file.
+    """
+    item = db_session.query(Item).filter_by(id=item_id).first()
+    if item is None:
+        # The item was deleted before it was processed
+        return
+    for key, value in make_variants(path, item.link).items():
+        setattr(item, key, value)
+    item.status = 'ready'
+    db_session.add(item)
+    db_session.commit()
+
+def set_item_status(item_id, status):
+    """Set the processing status of an item.
+
+    Arguments: item_id as int, status as string.
+    """
+    db_session.query(Item).filter_by(id=item_id).update({'status': status})
+    db_session.commit()
+
+
 # Edit an item
 @app.route('/inspiration/<int:item_id>/edit/', methods=['GET', 'POST'])
 def edit_item(item_id):
@@ -143,6 +218,7 @@ def edit_item(item_id):
         flash("This item does not exist")
         return redirect(url_for('index'))
     if request.method == 'POST' and item.user_id == login_session['user_id']:
+        was_counted = in_public_menu_count(item)
         item.title = request.form['title']
         item.artist = request.form['artist']
         item.note = request.form['note']
@@ -150,8 +226,12 @@ def edit_item(item_id):
         item.category_id = request.form['category']
         item.user_id = login_session['user_id']
         item.public = True if request.form.get('public') else False
+        set_item_tags(item)
         db_session.add(item)
         db_session.commit()
+        invalidate_item_boxes([item.id])
+        invalidate_category_menu(item.user_id,
+                                 was_counted or in_public_menu_count(item))
         flash("Inspiration successfully saved")
         db_session.refresh(item)
         return redirect(url_for('show_item', item_id=item.id))
@@ -188,17 +268,35 @@ def delete_item(item_id):
 
 def delete_file_and_row(item):
     """Function for deleting item entries from database as well as deleting
-    an item's uploaded file if present.
+    an item's uploaded file and its resized variants if present and not
+    used by other items.
 
     Argument: An Item object.
     """
-    try:
-        # The item name is saved in the link as a path.
-        filename = item.link.rsplit('/', 1)[1]
-        os.remove(os.path.join(app.config['UPLOAD_FOLDER'],
-                               item.user.username,
-                               filename))
-    except:
-        pass
+    item_id, link, variants = item.id, item.link, variant_filenames(item)
+    user_id, was_counted = item.user_id, in_public_menu_count(item)
+    tag_ids = [tag.id for tag in item.tags]
     db_session.delete(item)
+    db_session.flush()
+    delete_orphan_tags(tag_ids)
     db_session.commit()
+    invalidate_item_boxes([item_id])
+    invalidate_category_menu(user_id, was_counted)
+    # The file is only deleted if no other item links to the same content.
+    release_upload(link, variants)
+
+@job_handler('release_item_files')
+def release_item_files(files, directory=None):
+    """Background job: delete the files of deleted items, see release_uploads.
+
+    Arguments: List of [link, list of variant filenames] of deleted items,
+        directory inside UPLOAD_FOLDER to remove afterwards if it is empty
+        (optional).
+    """
+    release_uploads(files)
+    if directory:
+        try:
+            os.rmdir(os.path.join(app.config['UPLOAD_FOLDER'], directory))
+        except OSError:
+            # Not empty or already gone
+            pass
@@ -0,0 +1,182 @@
+"""Background jobs, stored in the database.
+
+Work that is too slow for a request is queued as a Job row and executed by
+a worker process (`FLASK_APP=pemoi flask worker`), so no message broker is
+required. Several workers can run at once: a job is claimed with a
+conditional UPDATE, so only one worker gets it. Failed jobs are retried
+with increasing delay until max_attempts is reached. Every claim counts as
+an attempt, so a job that kills its worker or never finishes is given up
+as well.
+
+Handlers are registered with the job_handler decorator and receive the
+job's payload as keyword arguments. With JOBS_INLINE set in the config,
+jobs run right away in the process that queues them (for development).
+
+Jobs that have failed for good stay in the job table with their last error
+and are written to the dead-letter log, the 'pemoi.dead_letter' logger. Set
+DEAD_LETTER_LOG to a file name to keep it in a file.
+"""
+
+import json
+import logging
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, and_
+
+from pemoi import app
+from .database_setup import Job
+from .pmoi_db_session import db_session
+
+JOBS_INLINE = app.config.get('JOBS_INLINE', False)
+# Seconds after which a running job is considered abandoned by its worker
+JOBS_TIMEOUT = app.config.get('JOBS_TIMEOUT', 600)
+# Delay before the first retry, doubled for each further attempt
+JOBS_RETRY_DELAY = app.config.get('JOBS_RETRY_DELAY', 10)
+
+# Registered handlers, job kind -> (function, failure callback)
+handlers = {}
+
+dead_letter_log = logging.getLogger('pemoi.dead_letter')
+if app.config.get('DEAD_LETTER_LOG'):
+    _handler = logging.FileHandler(app.config['DEAD_LETTER_LOG'])
+    _handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    dead_letter_log.addHandler(_handler)
+
+def job_handler(kind, on_failure=None):
+    """Register a function as handler for jobs of the given kind.
+
+    Arguments: kind as string, on_failure (optional), a function called with
+    the payload as keyword arguments when the job has failed for good.
+    """
+    def decorator(function):
+        handlers[kind] = (function, on_failure)
+        return function
+    return decorator
+
+def enqueue(kind, max_attempts=3, **payload):
+    """Queue a job and commit the session.
+
+    The job is committed together with everything else pending in the
+    session, e.g. the item that the job processes.
+
+    Arguments: kind as string, max_attempts as int (optional), payload as
+        JSON serialisable keyword arguments for the handler.
+    Return: Job object.
+    """
+    job = Job(kind=kind,
+              payload=json.dumps(payload),
+              max_attempts=max_attempts)
+    if JOBS_INLINE:
+        # Claimed right away by this process
+        job.status = 'running'
+        job.started = datetime.utcnow()
+        job.attempts = 1
+    db_session.add(job)
+    db_session.commit()
+    if JOBS_INLINE:
+        run_job(job)
+    return job
+
+def claim_job():
+    """Claim the next due job for this worker.
+
+    Claiming counts as an attempt, so a job whose worker dies while running
+    it is given up after max_attempts like a job that raises. Abandoned jobs
+    without attempts left are marked as failed instead of being claimed.
+    Return: Job object with status 'running', or None if nothing is due.
+    """
+    now = datetime.utcnow()
+    abandoned = now - timedelta(seconds=JOBS_TIMEOUT)
+    due = or_(and_(Job.status=='queued', Job.run_after <= now),
+              and_(Job.status=='running', Job.started < abandoned))
+    while True:
+        job = db_session.query(Job).filter(due).order_by(Job.id).first()
+        if job is None:
+            db_session.rollback()
+            return None
+        if job.status == 'running' and job.attempts >= job.max_attempts:
+            values = {'status': 'failed'}
+        else:
+            values = {'status': 'running', 'started': now,
+                      'attempts': Job.attempts + 1}
+        # Only one worker can win this update, the others try the next job.
+        claimed = db_session.query(Job)\
+                            .filter(Job.id==job.id, Job.status==job.status,
+                                    or_(Job.started==None,
+                                        Job.started==job.started))\
+                            .update(values, synchronize_session=False)
+        db_session.commit()
+        if not claimed:
+            continue
+        db_session.refresh(job)
+        if job.status == 'running':
+            return job
+        job.error = (job.error or '') + "Abandoned by its worker\n"
+        give_up(job)
+
+def give_up(job):
+    """Record that a job has failed for good.
+
+    Writes the job to the dead-letter log and calls the failure callback of
+    its handler, if any.
+    Argument: Job object with status 'failed' and its last error.
+    """
+    # The payload may hold secrets and is only kept in the table.
+    dead_letter_log.error("Job %d (%s) failed after %d attempts: %s",
+                          job.id, job.kind, job.attempts,
+                          job.error.strip().splitlines()[-1])
+    db_session.add(job)
+    db_session.commit()
+    on_failure = handlers.get(job.kind, (None, None))[1]
+    if on_failure:
+        on_failure(**json.loads(job.payload))
+
+def run_job(job):
+    """Run a claimed job and record the outcome.
+
+    Argument: Job object, its attempts already include this run.
+    Return: Boolean, True if the handler succeeded.
+    """
+    try:
+        payload = json.loads(job.payload)
+        function = handlers[job.kind][0]
+        function(**payload)
+    except Exception:
+        error = traceback.format_exc()
+        # Discard whatever the handler left in the session
+        db_session.rollback()
+        job.error = error
+        if job.attempts < job.max_attempts:
+            job.status = 'queued'
+            job.run_after = datetime.utcnow() + timedelta(
+                seconds=JOBS_RETRY_DELAY * 2 ** (job.attempts - 1))
+            db_session.add(job)
+            db_session.commit()
+        else:
+            job.status = 'failed'
+            give_up(job)
+        return False
+    job.status = 'done'
+    job.error = None
+    db_session.add(job)
+    db_session.commit()
+    return True
+
+def work(poll_interval=1.0, once=False):
+    """Process jobs until interrupted.
+
+    Arguments: poll_interval in seconds to wait when the queue is empty,
+        once as Boolean: stop when the queue is empty.
+    """
+    while True:
+        job = claim_job()
+        if job is None:
+            db_session.remove()
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+        run_job(job)
+        db_session.remove()
@@ -0,0 +1,39 @@
+"""Shared queries for item grids (index, own items and category pages)."""
+
+from sqlalchemy.orm import joinedload, load_only
+
+from .database_setup import Item
+from .pmoi_db_session import db_session
+from .pmoi_helpers import keyset_page, page_size
+
+# Columns that itembox.html and userbox.html actually render, and edit_date
+# for the version of cached item boxes, see pmoi_fragments
+ITEM_GRID_COLUMNS = ('id', 'link', 'title', 'artist', 'note', 'add_date',
+                     'public', 'user_id', 'category_id', 'thumb_link',
+                     'srcset', 'webp_srcset', 'status', 'edit_date')
+USER_GRID_COLUMNS = ('id', 'username', 'picture')
+CATEGORY_GRID_COLUMNS = ('id', 'name')
+
+def item_listing():
+    """Base query for rendering item grids.
+
+    User and category are loaded in the same query as the items, so rendering
+    a page of item boxes costs one query instead of one per item and
+    relationship. Only the columns shown in the grid are loaded.
+
+    Return: SQLAlchemy query for Item objects.
+    """
+    return db_session.query(Item).options(
+        load_only(*ITEM_GRID_COLUMNS),
+        joinedload(Item.user).load_only(*USER_GRID_COLUMNS),
+        joinedload(Item.category).load_only(*CATEGORY_GRID_COLUMNS))
+
+def item_listing_page(criterion, cursor=None, limit=None):
+    """Get one page of items for a grid, newest first.
+
+    Arguments: Filter criterion, cursor as string (optional), requested page
+        size (optional).
+    Return: Tuple (list of Item objects, cursor for the next page or None).
+    """
+    return keyset_page(item_listing().filter(criterion), Item, cursor,
+                       page_size(limit))
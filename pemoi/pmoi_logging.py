@@ -0,0 +1,57 @@
+"""Logging for the site.
+
+Modules log to children of the 'pemoi' logger, e.g. 'pemoi.pmoi_helpers'.
+Depending on the Flask version, that is or isn't the app's logger, so it
+is configured here: unless it has handlers already, it gets Flask's
+default handler, which writes to the WSGI error stream. Set LOG_LEVEL to
+choose which messages are written, and LOG_FORMAT to 'json' to write one
+JSON object per line, including the fields passed as `extra`, for log
+collectors.
+"""
+
+import json
+import logging
+
+from flask.logging import default_handler
+
+from pemoi import app
+
+# Attributes of every LogRecord, anything else was passed as extra
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord(
+    '', logging.INFO, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class JSONFormatter(logging.Formatter):
+    """Format records as JSON objects with time, level, logger, message and
+    any extra fields."""
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def configure_logging(config):
+    """Set level, handler and format of the 'pemoi' logger.
+
+    Argument: config with LOG_LEVEL (default: 'INFO', 'DEBUG' in debug mode)
+    and LOG_FORMAT ('text' or 'json').
+    Return: The 'pemoi' logger.
+    """
+    logger = logging.getLogger('pemoi')
+    level = config.get('LOG_LEVEL', 'DEBUG' if config.get('DEBUG') else 'INFO')
+    logger.setLevel(level)
+    if not logger.handlers:
+        logger.addHandler(default_handler)
+    if config.get('LOG_FORMAT', 'text') == 'json':
+        for handler in logger.handlers:
+            handler.setFormatter(JSONFormatter())
+    return logger
+
+configure_logging(app.config)
@@ -0,0 +1,252 @@
+"""Request, database and template timing.
+
+With METRICS_ENABLED set in the config, every request is timed and the
+queries it sends to the database are counted and timed, as are the
+templates it renders. The numbers are kept per worker process and served
+at /metrics in the Prometheus text format, labelled by endpoint and
+template. Requests slower than METRICS_SLOW_REQUEST_MS are logged with
+their timings to the 'pemoi.requests' logger.
+
+If METRICS_TOKEN is set, /metrics requires the header
+`Authorization: Bearer <METRICS_TOKEN>`.
+
+Without METRICS_ENABLED nothing is registered, neither the hooks nor the
+/metrics endpoint, so requests don't pay for instrumentation.
+"""
+
+import hmac
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from flask import request, g, has_request_context, abort
+from sqlalchemy import event, func
+
+from pemoi import app
+from .database_setup import Job
+from .pmoi_db_session import engine, db_session
+from .pmoi_fragments import fragment_stats
+
+METRICS_ENABLED = app.config.get('METRICS_ENABLED', False)
+METRICS_SLOW_REQUEST_MS = app.config.get('METRICS_SLOW_REQUEST_MS', 500)
+METRICS_TOKEN = app.config.get('METRICS_TOKEN')
+
+# Upper bounds in seconds of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+request_log = logging.getLogger('pemoi.requests')
+
+def escape(value):
+    """Escape a label value for the Prometheus text format."""
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+                     .replace('\n', r'\n')
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value))
+                             for name, value in zip(names, values))
+
+class Counter():
+    """Thread-safe counter with labels.
+
+    Arguments: name and help text of the metric, names of its labels.
+    """
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        """Add amount to the counter with the given label values."""
+        with self._lock:
+            self._values[labels] += amount
+
+    def render(self):
+        """Return the counter in the Prometheus text format."""
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s counter' % self.name]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append('%s%s %r' % (self.name,
+                                      format_labels(self.labels, labels),
+                                      value))
+        return lines
+
+class Histogram():
+    """Thread-safe histogram with labels and fixed buckets.
+
+    Arguments: name and help text of the metric, names of its labels.
+    """
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # Label values -> [count per bucket, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        """Record value for the given label values."""
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * len(BUCKETS), 0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        """Return the histogram in the Prometheus text format."""
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s histogram' % self.name]
+        with self._lock:
+            values = sorted((labels, [list(entry[0]), entry[1], entry[2]])
+                            for labels, entry in self._values.items())
+        names = self.labels + ('le',)
+        for labels, (buckets, total, count) in values:
+            cumulative = 0
+            for bound, n in zip(BUCKETS, buckets):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (
+                    self.name, format_labels(names, labels + (bound,)),
+                    cumulative))
+            lines.append('%s_bucket%s %d' % (
+                self.name, format_labels(names, labels + ('+Inf',)), count))
+            label_text = format_labels(self.labels, labels)
+            lines.append('%s_sum%s %r' % (self.name, label_text, total))
+            lines.append('%s_count%s %d' % (self.name, label_text, count))
+        return lines
+
+request_seconds = Histogram(
+    'pemoi_request_duration_seconds', "Time to answer a request.",
+    ('method', 'endpoint', 'status'))
+db_queries = Counter(
+    'pemoi_db_queries_total', "SQL statements sent while answering requests.",
+    ('endpoint',))
+db_seconds = Counter(
+    'pemoi_db_seconds_total', "Time spent in SQL statements of requests.",
+    ('endpoint',))
+template_seconds = Histogram(
+    'pemoi_template_render_seconds', "Time to render a template.",
+    ('template',))
+
+def endpoint_label():
+    """Return the endpoint of the current request, with a fixed value for
+    URLs that match no route, so that labels stay few."""
+    return request.endpoint or 'unmatched'
+
+def start_timer():
+    g.request_start = time.perf_counter()
+    g.db_queries = 0
+    g.db_seconds = 0.0
+
+def record_request(response):
+    """Record the timings of the request, log it if it was slow."""
+    start = g.get('request_start')
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    endpoint = endpoint_label()
+    request_seconds.observe(elapsed, (request.method, endpoint,
+                                      response.status_code))
+    db_queries.inc((endpoint,), g.db_queries)
+    db_seconds.inc((endpoint,), g.db_seconds)
+    if elapsed * 1000 >= METRICS_SLOW_REQUEST_MS:
+        request_log.warning(
+            "Slow request %s %s: %.0f ms", request.method, request.path,
+            elapsed * 1000,
+            extra={'method': request.method, 'path': request.path,
+                   'endpoint': endpoint, 'status': response.status_code,
+                   'duration_ms': round(elapsed * 1000, 1),
+                   'db_queries': g.db_queries,
+                   'db_ms': round(g.db_seconds * 1000, 1)})
+    return response
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    start = conn.info['query_start'].pop()
+    if has_request_context() and 'request_start' in g:
+        g.db_queries += 1
+        g.db_seconds += time.perf_counter() - start
+
+def handle_error(context):
+    # after_cursor_execute isn't called for failed statements
+    if context.connection is not None:
+        starts = context.connection.info.get('query_start')
+        if starts:
+            starts.pop()
+
+def timed_template_class(base):
+    """Return a subclass of the Jinja template class base that records the
+    time of every render. Templates included by a rendered template are
+    part of its time."""
+    class TimedTemplate(base):
+        def render(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return super().render(*args, **kwargs)
+            finally:
+                template_seconds.observe(time.perf_counter() - start,
+                                         (self.name or 'string',))
+    return TimedTemplate
+
+def process_metrics():
+    """Return lines with this worker's cache statistics and the number of
+    jobs in the queue by status."""
+    stats = fragment_stats()
+    lines = ['# HELP pemoi_fragment_cache_hits_total Item boxes served '
+             'from the cache.',
+             '# TYPE pemoi_fragment_cache_hits_total counter',
+             'pemoi_fragment_cache_hits_total %d' % stats['hits'],
+             '# HELP pemoi_fragment_cache_misses_total Item boxes rendered.',
+             '# TYPE pemoi_fragment_cache_misses_total counter',
+             'pemoi_fragment_cache_misses_total %d' % stats['misses'],
+             '# HELP pemoi_fragment_cache_items Items with cached boxes.',
+             '# TYPE pemoi_fragment_cache_items gauge',
+             'pemoi_fragment_cache_items %d' % stats['size'],
+             '# HELP pemoi_jobs Background jobs by status.',
+             '# TYPE pemoi_jobs gauge']
+    jobs = db_session.query(Job.status, func.count(Job.id)) \
+                     .group_by(Job.status).all()
+    for status, count in sorted(jobs):
+        lines.append('pemoi_jobs%s %d' % (format_labels(('status',),
+                                                         (status,)), count))
+    return lines
+
+def metrics():
+    """Serve all metrics of this worker in the Prometheus text format."""
+    if METRICS_TOKEN:
+        expected = 'Bearer %s' % METRICS_TOKEN
+        given = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(given.encode(), expected.encode()):
+            abort(401)
+    lines = []
+    for metric in (request_seconds, db_queries, db_seconds,
+                   template_seconds):
+        lines.extend(metric.render())
+    lines.extend(process_metrics())
+    return ('\n'.join(lines) + '\n', 200,
+            {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+             'Cache-Control': 'no-store'})
+
+if METRICS_ENABLED:
+    app.before_request(start_timer)
+    app.after_request(record_request)
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(engine, 'handle_error', handle_error)
+    app.jinja_env.template_class = \
+        timed_template_class(app.jinja_env.template_class)
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -0,0 +1,98 @@
+"""Shared HTTP client for the OAuth providers (Google, Facebook, github).
+
+Client secrets are read once per process. All calls go through one pooled
+requests session, so connections to a provider are kept alive between
+logins, and every call has a timeout. Independent calls, e.g. profile and
+picture, can be sent concurrently with fetch_all.
+
+Set OAUTH_PROVIDER_URLS to a dictionary overriding entries of PROVIDER_URLS
+to test against a local fake provider.
+"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pemoi import app
+from config import _basedir
+
+PROVIDER_URLS = {
+    'facebook': 'https://graph.facebook.com',
+    'google_accounts': 'https://accounts.google.com',
+    'google_api': 'https://www.googleapis.com',
+    'google_token': 'https://oauth2.googleapis.com/token',
+    'github': 'https://github.com',
+    'github_api': 'https://api.github.com',
+}
+PROVIDER_URLS.update(app.config.get('OAUTH_PROVIDER_URLS', {}))
+# Seconds to connect and to wait for the response
+OAUTH_TIMEOUT = app.config.get('OAUTH_TIMEOUT', (3.05, 10))
+OAUTH_POOL_SIZE = app.config.get('OAUTH_POOL_SIZE', 10)
+
+# Threads for concurrent calls, shared by all requests of the process
+_executor = ThreadPoolExecutor(max_workers=app.config.get('OAUTH_WORKERS', 4))
+
+
+class ProviderError(Exception):
+    """The provider could not be reached or did not answer in time."""
+
+
+@lru_cache(maxsize=None)
+def load_secrets(provider):
+    """Read a provider's client secrets on first use and reuse them.
+
+    Argument: provider as string, e.g. 'google' for
+        google_client_secrets.json in the base directory.
+    Return: Dictionary, the 'web' section of the file.
+    """
+    json_file = os.path.join(_basedir, '%s_client_secrets.json' % provider)
+    with open(json_file, 'r') as f:
+        return json.load(f)['web']
+
+@lru_cache(maxsize=None)
+def get_session():
+    """Create the HTTP session for all providers on first use.
+
+    Keeps up to OAUTH_POOL_SIZE connections per provider host open.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=OAUTH_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def provider_url(name, path=''):
+    """Return the URL of a provider endpoint, see PROVIDER_URLS."""
+    return PROVIDER_URLS[name] + path
+
+def call(method, url, **kwargs):
+    """Send a request to a provider with the shared session and a timeout.
+
+    Arguments: HTTP method and URL as strings, further keyword arguments for
+        requests (params, data, headers, ...).
+    Return: requests.Response.
+    Raises ProviderError if the provider can't be reached in time.
+    """
+    kwargs.setdefault('timeout', OAUTH_TIMEOUT)
+    try:
+        return get_session().request(method, url, **kwargs)
+    except requests.RequestException as err:
+        # Messages of requests contain the URL, which may hold a token.
+        raise ProviderError("%s for %s" % (type(err).__name__,
+                                          urlsplit(url).netloc))
+
+def fetch_all(*calls):
+    """Send independent calls concurrently.
+
+    Arguments: Tuples (method, url, keyword arguments as dict).
+    Return: List of requests.Response, in the order of the calls.
+    Raises ProviderError if any call fails.
+    """
+    futures = [_executor.submit(call, method, url, **kwargs)
+               for method, url, kwargs in calls]
+    return [future.result() for future in futures]
@@ -0,0 +1,160 @@
+"""Full-text search over items.
+
+Title, artist, note and keywords of items are indexed by the database
+itself, with the backend chosen by the dialect of DB_URI:
+
+- SQLite: an FTS5 table item_fts with the item table as external content,
+  kept in sync by triggers, ranked by bm25().
+- PostgreSQL: a GIN index on the tsvector of the same columns, ranked by
+  ts_rank().
+- Other databases: LIKE matching, ordered by newest first.
+
+The index is created by migration 6 (see database_migrations) and
+is updated by the database on every insert, update and delete of an item,
+so every code path that changes items keeps it in sync.
+
+Results are ordered by score (lower is better) and item id, and paginated
+with a keyset cursor on these two values. Scores are rounded to integers in
+the database, so that the cursor compares exactly.
+"""
+
+import re
+from flask import render_template, \
+                  request, \
+                  session as login_session, \
+                  jsonify
+from sqlalchemy import and_, or_, func, literal_column, table, column, \
+                       text, inspect, cast, Float, BigInteger
+
+from pemoi import app
+from .database_migrations import SEARCH_COLUMNS, PG_TS_CONFIG, PG_DOCUMENT, \
+                                  sqlite_has_fts5
+from .database_setup import Item
+from .pmoi_db_session import db_session
+from .pmoi_helpers import page_size, encode_key, decode_key
+from .pmoi_listing import item_listing
+
+# Scores are compared with this many digits after the decimal point
+SCORE_SCALE = 10 ** 9
+
+# Set once the backend is known for good
+_backend = None
+
+def search_backend():
+    """Return 'sqlite', 'postgresql' or 'like', depending on the database.
+
+    Without the FTS5 table the answer isn't remembered if SQLite has FTS5,
+    because migration 6 creates the table later.
+    """
+    global _backend
+    if _backend is not None:
+        return _backend
+    bind = db_session.get_bind()
+    name = bind.dialect.name
+    if name == 'sqlite' \
+       and 'item_fts' not in inspect(bind).get_table_names():
+        if sqlite_has_fts5(bind):
+            return 'like'
+        name = 'like'
+    elif name not in ('sqlite', 'postgresql'):
+        name = 'like'
+    _backend = name
+    return name
+
+def stable_score(score):
+    """Round a float score to an integer in SQL.
+
+    Cursors hold the rounded score, which compares exactly in the database,
+    unlike a float that went through JSON (ts_rank is a float4).
+    """
+    return cast(func.round(cast(score, Float) * SCORE_SCALE), BigInteger)
+
+def search_terms(query):
+    """Split a search query into words, dropping all search syntax."""
+    return re.findall(r'\w+', query or '')[:10]
+
+def _ranked(terms, backend):
+    """Subquery with columns id and score for items matching all terms."""
+    if backend == 'sqlite':
+        # Prefix match on every word, e.g. '"blue"* "sky"*'
+        match = ' '.join('"%s"*' % t for t in terms)
+        fts = table('item_fts', column('rowid'))
+        return db_session.query(fts.c.rowid.label('id'),
+                                stable_score(
+                                    func.bm25(literal_column('item_fts')))
+                                    .label('score'))\
+                         .select_from(fts)\
+                         .filter(text('item_fts MATCH :match')
+                                     .bindparams(match=match))\
+                         .subquery()
+    if backend == 'postgresql':
+        tsquery = func.to_tsquery(PG_TS_CONFIG,
+                                  ' & '.join('%s:*' % t for t in terms))
+        document = literal_column(PG_DOCUMENT)
+        return db_session.query(Item.id.label('id'),
+                                stable_score(
+                                    -func.ts_rank(document, tsquery))
+                                    .label('score'))\
+                         .filter(document.op('@@')(tsquery))\
+                         .subquery()
+    # Every word has to appear in one of the columns, newest items first
+    criteria = [or_(*[getattr(Item, c).ilike('%' + t + '%')
+                      for c in SEARCH_COLUMNS]) for t in terms]
+    return db_session.query(Item.id.label('id'),
+                            (-Item.id).label('score'))\
+                     .filter(and_(*criteria))\
+                     .subquery()
+
+def search_items(query, user_id=None, cursor=None, limit=None):
+    """Search items visible to a user, best matches first.
+
+    Arguments: search query as string, user_id of the viewer (optional),
+        cursor as string (optional), requested page size (optional).
+    Return: Tuple (list of Item objects, cursor for the next page or None).
+    """
+    terms = search_terms(query)
+    if not terms:
+        return [], None
+    ranked = _ranked(terms, search_backend())
+    # Same visibility rule as for items on category pages
+    results = item_listing().join(ranked, ranked.c.id==Item.id)\
+                            .add_columns(ranked.c.score)\
+                            .filter((Item.public==True)|
+                                    (Item.user_id==user_id))
+    key = decode_key(cursor, int, int)
+    if key:
+        score, last_id = key
+        results = results.filter(or_(ranked.c.score > score,
+                                     and_(ranked.c.score == score,
+                                          Item.id > last_id)))
+    size = page_size(limit)
+    rows = results.order_by(ranked.c.score, Item.id).limit(size + 1).all()
+    next_cursor = None
+    if len(rows) > size:
+        rows = rows[:size]
+        last, score = rows[-1]
+        next_cursor = encode_key(score, last.id)
+    return [item for item, score in rows], next_cursor
+
+
+@app.route('/search/')
+def search():
+    """Render search form and one page of results."""
+    query = request.args.get('q', '')
+    items, next_cursor = search_items(query,
+                                      login_session.get('user_id'),
+                                      request.args.get('cursor'),
+                                      request.args.get('limit'))
+    return render_template('search.html',
+                           query=query,
+                           items=items,
+                           next_cursor=next_cursor)
+
+@app.route('/search/json/')
+def search_json():
+    """Return one page of search results in JSON format"""
+    items, next_cursor = search_items(request.args.get('q', ''),
+                                      login_session.get('user_id'),
+                                      request.args.get('cursor'),
+                                      request.args.get('limit'))
+    return jsonify(Items=[i.serialize for i in items], next=next_cursor)
@@ -0,0 +1,290 @@
+"""Server-side sessions.
+
+With the default cookie sessions, everything in `login_session` is signed
+and sent back and forth in a cookie with every request. A server-side store
+keeps the data on the server instead; the cookie only carries a random
+session ID.
+
+Select the store with SESSION_BACKEND:
+'cookie': Flask's signed cookie sessions (default)
+'sqlite': a SQLite file shared by all workers on one host
+'redis': a Redis server shared by all hosts (requires the redis package)
+'memory': a dictionary per worker process, for development and tests
+
+Expired sessions are never loaded. Redis removes them itself, the SQLite
+store is swept now and then while sessions are saved and with
+`FLASK_APP=pemoi flask sweep-sessions`.
+"""
+
+import os
+import random
+import re
+import secrets
+import sqlite3
+import threading
+import time
+
+import click
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from pemoi import app
+
+# 32 random bytes, URL-safe base64 encoded
+SID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{43}$')
+
+serializer = TaggedJSONSerializer()
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session data of one request, stored under the ID sid.
+
+    Arguments: initial data, sid (None for a new session), user_id the
+    session belonged to when it was loaded, refresh if the stored expiry
+    should be extended even if the data is unchanged.
+    """
+    def __init__(self, initial=None, sid=None, user_id=None, refresh=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.loaded_user_id = user_id
+        self.new = sid is None
+        self.modified = refresh
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keep sessions in store, send only their IDs in the session cookie.
+
+    A session is written back only if it was changed or is about to expire,
+    so most requests cost one read. When the logged in user changes, the
+    session gets a new ID, so an ID known before login is of no use after.
+
+    Arguments: store with the interface of SQLiteSessionStore.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if not sid or not SID_PATTERN.match(sid):
+            return ServerSession()
+        stored = self.store.load(sid)
+        if stored is None:
+            return ServerSession()
+        data, expires = stored
+        try:
+            data = serializer.loads(data)
+        except ValueError:
+            return ServerSession()
+        # Extend sliding expiry once half of the lifetime has passed
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        refresh = expires - time.time() < lifetime / 2
+        return ServerSession(data, sid=sid, user_id=data.get('user_id'),
+                             refresh=refresh)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session or not session.new:
+            response.vary.add('Cookie')
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+        if session.get('user_id') != session.loaded_user_id \
+           and not session.new:
+            self.store.delete(session.sid)
+            session.sid = None
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        elif not session.modified:
+            return
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        self.store.save(session.sid, serializer.dumps(dict(session)),
+                        time.time() + lifetime)
+        response.set_cookie(app.session_cookie_name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+
+class SQLiteSessionStore():
+    """Sessions in a SQLite file, shared by all workers on this host.
+
+    Each thread has its own connection. Saving sweeps expired sessions with
+    probability sweep_probability.
+
+    Arguments: path of the database file, sweep_probability.
+    """
+    def __init__(self, path, sweep_probability=0.001):
+        self.path = path
+        self.sweep_probability = sweep_probability
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Not kept open, so that forked workers don't share the connection
+        connection = sqlite3.connect(path, timeout=10)
+        try:
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS session "
+                                   "(sid TEXT PRIMARY KEY, "
+                                   "data TEXT NOT NULL, "
+                                   "expires REAL NOT NULL)")
+                connection.execute("CREATE INDEX IF NOT EXISTS "
+                                   "ix_session_expires ON session (expires)")
+        finally:
+            connection.close()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            # Readers don't wait for writers
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def load(self, sid):
+        """Return (data, expiry timestamp) of session sid, or None if it
+        doesn't exist or has expired."""
+        return self._connection().execute(
+            "SELECT data, expires FROM session WHERE sid = ? AND expires > ?",
+            (sid, time.time())).fetchone()
+
+    def save(self, sid, data, expires):
+        """Store data as session sid until timestamp expires."""
+        with self._connection() as connection:
+            connection.execute("REPLACE INTO session (sid, data, expires) "
+                               "VALUES (?, ?, ?)", (sid, data, expires))
+        if random.random() < self.sweep_probability:
+            self.sweep()
+
+    def delete(self, sid):
+        """Remove session sid."""
+        with self._connection() as connection:
+            connection.execute("DELETE FROM session WHERE sid = ?", (sid,))
+
+    def sweep(self):
+        """Remove all expired sessions. Return their number."""
+        with self._connection() as connection:
+            cursor = connection.execute(
+                "DELETE FROM session WHERE expires <= ?", (time.time(),))
+        return cursor.rowcount
+
+
+class MemorySessionStore():
+    """Sessions in a dictionary, private to this worker process.
+
+    Has the same interface as RedisSessionStore and stands in for it in
+    development and tests.
+    """
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        """Return (data, expiry timestamp) of session sid, or None if it
+        doesn't exist or has expired."""
+        stored = self._data.get(sid)
+        if stored is None or stored[1] <= time.time():
+            return None
+        return stored
+
+    def save(self, sid, data, expires):
+        """Store data as session sid until timestamp expires."""
+        with self._lock:
+            self._data[sid] = (data, expires)
+
+    def delete(self, sid):
+        """Remove session sid."""
+        with self._lock:
+            self._data.pop(sid, None)
+
+    def sweep(self):
+        """Remove all expired sessions. Return their number."""
+        now = time.time()
+        with self._lock:
+            expired = [sid for sid, (_, expires) in self._data.items()
+                       if expires <= now]
+            for sid in expired:
+                del self._data[sid]
+        return len(expired)
+
+
+class RedisSessionStore():
+    """Sessions in Redis, shared by all workers and hosts.
+
+    Redis removes expired sessions itself.
+
+    Arguments: url of the Redis server, e.g. 'redis://localhost:6379/0',
+    prefix for all keys.
+    """
+    def __init__(self, url, prefix='pemoi:session:'):
+        # Optional dependency, only needed if Redis sessions are configured
+        import redis
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+
+    def load(self, sid):
+        """Return (data, expiry timestamp) of session sid, or None if it
+        doesn't exist or has expired."""
+        pipe = self._redis.pipeline()
+        pipe.get(self.prefix + sid)
+        pipe.pttl(self.prefix + sid)
+        data, ttl = pipe.execute()
+        if data is None or ttl < 0:
+            return None
+        return data.decode('utf-8'), time.time() + ttl / 1000
+
+    def save(self, sid, data, expires):
+        """Store data as session sid until timestamp expires."""
+        ttl = max(1, int((expires - time.time()) * 1000))
+        self._redis.set(self.prefix + sid, data, px=ttl)
+
+    def delete(self, sid):
+        """Remove session sid."""
+        self._redis.delete(self.prefix + sid)
+
+    def sweep(self):
+        """Expired sessions are removed by Redis. Return 0."""
+        return 0
+
+
+def make_session_store(config):
+    """Create the session store selected by SESSION_BACKEND.
+
+    Argument: config of the app.
+    Return: store, None for cookie sessions
+    """
+    backend = config.get('SESSION_BACKEND', 'cookie')
+    if backend == 'cookie':
+        return None
+    if backend == 'sqlite':
+        path = config.get('SESSION_SQLITE_PATH',
+                          os.path.join(app.instance_path, 'sessions.db'))
+        return SQLiteSessionStore(
+            path, config.get('SESSION_SWEEP_PROBABILITY', 0.001))
+    if backend == 'redis':
+        return RedisSessionStore(config['SESSION_REDIS_URL'])
+    if backend == 'memory':
+        return MemorySessionStore()
+    raise ValueError("Unknown SESSION_BACKEND %r" % backend)
+
+session_store = make_session_store(app.config)
+if session_store is not None:
+    app.session_interface = ServerSessionInterface(session_store)
+
+@app.cli.command('sweep-sessions')
+def sweep_sessions_command():
+    """Remove expired server-side sessions."""
+    if session_store is None:
+        click.echo("Sessions are stored in cookies, nothing to sweep")
+        return
+    click.echo("Removed %d expired sessions" % session_store.sweep())
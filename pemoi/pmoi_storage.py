@@ -0,0 +1,249 @@
+"""Content-addressed storage for uploaded files.
+
+Uploads are stored under UPLOAD_FOLDER/blob/<aa>/<bb>/<sha256>.<ext>, where
+<aa> and <bb> are the first two byte pairs of the SHA-256 hash of the file.
+Identical uploads are stored once, no matter how many users upload them,
+and file names no longer depend on the uploader's username. A file is
+removed when the last item that links to it is deleted.
+
+Uploads from before the content store live in UPLOAD_FOLDER/<username>/
+and are still served and deleted from there.
+
+File uploads in requests are streamed straight into a temporary file next
+to the store while they are received (see UploadRequest), so the request
+body is never buffered in memory, is hashed on the fly, and oversized or
+non-image uploads are rejected as soon as their first bytes arrive.
+"""
+
+import hashlib
+import os
+import tempfile
+
+from flask import g, Request
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+from pemoi import app
+from .database_setup import Item
+from .pmoi_db_session import db_session
+
+# Directory inside UPLOAD_FOLDER. Shorter than any valid username.
+BLOB_DIR = 'blob'
+CHUNK_SIZE = 64 * 1024
+# Maximum size of a single uploaded file in bytes
+MAX_UPLOAD_SIZE = app.config.get('MAX_UPLOAD_SIZE', 10 * 1024 * 1024)
+# Reject whole requests above this size before reading the body
+app.config.setdefault('MAX_CONTENT_LENGTH', MAX_UPLOAD_SIZE + 64 * 1024)
+
+# File signatures of allowed image types and the extension to store them with
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+# Number of bytes needed to identify any of the above
+SIGNATURE_LENGTH = max(len(signature) for signature, ext in IMAGE_SIGNATURES)
+
+def sniff_image_type(head):
+    """Identify an image by its first bytes.
+
+    Argument: The first bytes of a file as bytes.
+    Return: File extension ('png', 'jpg' or 'gif') or None if the bytes are
+        not the start of an allowed image type.
+    """
+    for signature, ext in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    return None
+
+def tmp_dir():
+    """Return the directory for incoming files, on the store's file system."""
+    path = os.path.join(app.config['UPLOAD_FOLDER'], BLOB_DIR, 'tmp')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class UploadFile():
+    """Temporary file that receives an upload while the request is parsed.
+
+    Hashes and counts the bytes as they are written, checks the file
+    signature and enforces MAX_UPLOAD_SIZE. Reading, seeking and closing are
+    passed on to the underlying file.
+    """
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(dir=tmp_dir())
+        self.file = os.fdopen(fd, 'wb+')
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+        # Remember the file, so that it is removed after the request if it
+        # was not moved into the store.
+        g.setdefault('upload_files', []).append(self.path)
+
+    @property
+    def image_type(self):
+        """File extension of the received image or None, see sniff_image_type"""
+        return sniff_image_type(self.head)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > MAX_UPLOAD_SIZE:
+            raise RequestEntityTooLarge(
+                "Uploads can have at most %d MB" % (MAX_UPLOAD_SIZE // 2**20))
+        if len(self.head) < SIGNATURE_LENGTH:
+            self.head += data[:SIGNATURE_LENGTH - len(self.head)]
+            if len(self.head) == SIGNATURE_LENGTH and not self.image_type:
+                raise UnsupportedMediaType(
+                    "Only .png, .jpg/jpeg or .gif images can be uploaded")
+        self.digest.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class UploadRequest(Request):
+    """Request class that streams file uploads into UploadFile objects."""
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return UploadFile()
+
+app.request_class = UploadRequest
+
+@app.teardown_request
+def remove_upload_files(exception=None):
+    """Remove temporary upload files that were not moved into the store."""
+    for path in g.pop('upload_files', []):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def upload_url(relative_path):
+    """Return the link for a file inside UPLOAD_FOLDER."""
+    return '%s/users/%s' % (app.static_url_path, relative_path)
+
+def upload_path(link):
+    """Return the file system path of an uploaded file.
+
+    Argument: Link as stored in item.link.
+    Return: Path inside UPLOAD_FOLDER, or None if the link does not point to
+        an upload (e.g. an external image link).
+    """
+    prefix = upload_url('')
+    if not link or not link.startswith(prefix):
+        return None
+    root = os.path.realpath(app.config['UPLOAD_FOLDER'])
+    path = os.path.realpath(os.path.join(root, link[len(prefix):]))
+    if not path.startswith(root + os.sep):
+        return None
+    return path
+
+def _store(tmp_path, name, ext):
+    """Move a temporary file to its place in the store, atomically.
+
+    Arguments: Path of the temporary file, hex digest and extension.
+    Return: Tuple (path, link, existed).
+    """
+    relative_path = '/'.join((BLOB_DIR, name[:2], name[2:4],
+                              '%s.%s' % (name, ext)))
+    path = os.path.join(app.config['UPLOAD_FOLDER'], *relative_path.split('/'))
+    existed = os.path.exists(path)
+    if existed:
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+    return path, upload_url(relative_path), existed
+
+def store_upload(stream):
+    """Store an uploaded image by its content hash.
+
+    A stream received as UploadFile is already hashed and on disk and is
+    just moved into place. Any other file-like object is copied in chunks to
+    a temporary file while hashing. If the same content is already stored,
+    the new copy is discarded.
+
+    Argument: File-like object, e.g. the stream of an uploaded file.
+    Return: Tuple (path, link, existed), existed is True if the content had
+        been stored before. None if the file is not an allowed image.
+    """
+    if isinstance(stream, UploadFile):
+        stream.file.close()
+        if not stream.image_type:
+            return None
+        return _store(stream.path, stream.digest.hexdigest(),
+                      stream.image_type)
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir())
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            chunk = stream.read(CHUNK_SIZE)
+            ext = sniff_image_type(chunk)
+            if not ext:
+                return None
+            while chunk:
+                digest.update(chunk)
+                tmp.write(chunk)
+                chunk = stream.read(CHUNK_SIZE)
+        return _store(tmp_path, digest.hexdigest(), ext)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def release_upload(link, extra_filenames=()):
+    """Delete an uploaded file if no item links to it anymore.
+
+    Call after the item row has been deleted.
+
+    Arguments: Link of the deleted item, names of further files in the same
+        directory that belong to it (e.g. resized variants).
+    Return: Boolean, True if files were deleted.
+    """
+    return release_uploads([(link, extra_filenames)]) > 0
+
+def release_uploads(files, batch_size=500):
+    """Delete uploaded files that no item links to anymore, in batches.
+
+    Call after the item rows have been deleted. Links that are still in use
+    are looked up with one query per batch instead of one per file.
+
+    Arguments: List of tuples (link, names of further files in the same
+        directory), batch_size as int (optional).
+    Return: Number of uploads whose files were deleted.
+    """
+    uploads = [(link, extra) for link, extra in files
+               if upload_path(link) is not None]
+    released = 0
+    for start in range(0, len(uploads), batch_size):
+        batch = uploads[start:start + batch_size]
+        in_use = set(link for link, in db_session.query(Item.link)\
+                     .filter(Item.link.in_(set(l for l, _ in batch))))
+        for link, extra_filenames in batch:
+            if link in in_use:
+                continue
+            # The same link can be released by several deleted items
+            in_use.add(link)
+            path = upload_path(link)
+            directory = os.path.dirname(path)
+            for filename in [os.path.basename(path)] + list(extra_filenames):
+                try:
+                    os.remove(os.path.join(directory, filename))
+                except OSError:
+                    pass
+            released += 1
+    return released
+
+def move_to_store(path):
+    """Move an existing file into the content store.
+
+    Argument: Path of the file.
+    Return: Tuple (path, link) of the stored file, None if the file is not an
+        allowed image.
+    """
+    with open(path, 'rb') as f:
+        stored = store_upload(f)
+    if stored is None:
+        return None
+    os.remove(path)
+    return stored[:2]
@@ -0,0 +1,186 @@
+"""Tags parsed from the items' keywords, tag pages and tag auto-complete.
+
+The free-form keywords string of an item stays as entered. On every save it
+is split into tags, which are stored once in the tag table and linked to
+items through item_tag, so all items with a tag are found through an index
+instead of a LIKE scan over keywords. Tags that no item uses anymore are
+deleted, and tags are only shown to users who may see one of their items.
+"""
+
+import re
+
+from flask import flash, \
+                  redirect, \
+                  render_template, \
+                  request, \
+                  session as login_session, \
+                  url_for, \
+                  jsonify
+from sqlalchemy import desc, func
+
+from pemoi import app
+from .database_setup import Item, Tag, item_tag
+from .pmoi_db_session import db_session
+from .pmoi_jobs import job_handler, enqueue
+from .pmoi_listing import item_listing_page
+
+TAG_MAX_LENGTH = 50
+# Number of tags on the tags page
+TAG_CLOUD_SIZE = app.config.get('TAG_CLOUD_SIZE', 200)
+
+def parse_keywords(keywords):
+    """Split a keywords string into tag names.
+
+    Keywords are separated by commas or semicolons. Tag names are lower
+    case with single spaces.
+    Argument: Keywords as string (or None).
+    Return: List of unique tag names, in order of appearance.
+    """
+    names = []
+    for keyword in re.split(r'[,;]', keywords or ''):
+        name = ' '.join(keyword.lower().split())[:TAG_MAX_LENGTH]
+        if name and name not in names:
+            names.append(name)
+    return names
+
+def get_or_create_tags(names, known=None):
+    """Get Tag objects for names, creating the ones that don't exist yet.
+
+    Arguments: List of tag names, optional dictionary of already loaded
+        tags by name, which is updated.
+    Return: List of Tag objects.
+    """
+    known = {} if known is None else known
+    missing = [n for n in names if n not in known]
+    if missing:
+        for tag in db_session.query(Tag).filter(Tag.name.in_(missing)):
+            known[tag.name] = tag
+    for name in names:
+        if name not in known:
+            known[name] = Tag(name=name)
+            db_session.add(known[name])
+    return [known[n] for n in names]
+
+def set_item_tags(item, known=None):
+    """Replace an item's tags with the ones parsed from its keywords.
+
+    Arguments: Item object, optional dictionary of known tags (see
+        get_or_create_tags).
+    """
+    old_ids = [tag.id for tag in item.tags if tag.id is not None]
+    item.tags = get_or_create_tags(parse_keywords(item.keywords), known)
+    removed = set(old_ids) - set(tag.id for tag in item.tags)
+    if removed:
+        db_session.flush()
+        delete_orphan_tags(removed)
+
+def delete_orphan_tags(tag_ids, batch_size=500):
+    """Delete those of the given tags that no item uses anymore.
+
+    Runs in the current transaction, after the item's links have been
+    flushed. Tags of deleted items would otherwise still be listed.
+    Arguments: Tag IDs, batch_size as int.
+    """
+    tag_ids = list(tag_ids)
+    used = db_session.query(item_tag.c.tag_id)\
+                     .filter(item_tag.c.tag_id==Tag.id).exists()
+    for start in range(0, len(tag_ids), batch_size):
+        db_session.query(Tag)\
+                  .filter(Tag.id.in_(tag_ids[start:start + batch_size]),
+                          ~used)\
+                  .delete(synchronize_session=False)
+
+def prefix_range(prefix):
+    """Return the criterion for tag names starting with prefix.
+
+    Expressed as a range instead of LIKE, so that every database uses the
+    unique index on tag names.
+    """
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return (Tag.name >= prefix) & (Tag.name < upper)
+
+def visible(user_id):
+    """Criterion for items that a user may see."""
+    return (Item.public==True) | (Item.user_id==user_id)
+
+def has_visible_items(user_id):
+    """Criterion for tags with at least one item that a user may see."""
+    return db_session.query(item_tag.c.item_id)\
+                     .join(Item, Item.id==item_tag.c.item_id)\
+                     .filter(item_tag.c.tag_id==Tag.id, visible(user_id))\
+                     .exists()
+
+
+@job_handler('backfill_tags')
+def backfill_tags(after_id=0, batch_size=500):
+    """Background job: create tags for items saved before tags existed.
+
+    Processes one batch of items in a transaction and queues the next batch.
+    Arguments: Process items with id greater than after_id, batch_size as
+        int.
+    """
+    items = db_session.query(Item).filter(Item.id > after_id)\
+                      .order_by(Item.id).limit(batch_size).all()
+    known = {}
+    for item in items:
+        set_item_tags(item, known)
+    db_session.commit()
+    if len(items) == batch_size:
+        enqueue('backfill_tags', after_id=items[-1].id, batch_size=batch_size)
+
+
+@app.route('/tags/')
+def show_tags():
+    """Show the most used tags with the number of public items."""
+    count = func.count(item_tag.c.item_id).label('count')
+    tags = db_session.query(Tag.name, count)\
+                     .join(item_tag, item_tag.c.tag_id==Tag.id)\
+                     .join(Item, Item.id==item_tag.c.item_id)\
+                     .filter(Item.public==True)\
+                     .group_by(Tag.id, Tag.name)\
+                     .order_by(desc(count), Tag.name)\
+                     .limit(TAG_CLOUD_SIZE).all()
+    return render_template('tags.html', tags=tags)
+
+@app.route('/tag/<name>/')
+def show_tag(name):
+    """Show all items with a tag that the user may see."""
+    user_id = login_session.get('user_id')
+    tag = db_session.query(Tag).filter_by(name=name.lower()).first()
+    count = 0
+    if tag is not None:
+        count = db_session.query(func.count(item_tag.c.item_id))\
+                          .join(Item, Item.id==item_tag.c.item_id)\
+                          .filter(item_tag.c.tag_id==tag.id,
+                                  visible(user_id))\
+                          .scalar()
+    # Tags of other users' private items look like unknown tags
+    if not count:
+        flash("There are no inspirations with this tag")
+        return redirect(url_for('show_tags'))
+    tagged = db_session.query(item_tag.c.item_id)\
+                       .filter(item_tag.c.tag_id==tag.id)
+    items, next_cursor = item_listing_page(Item.id.in_(tagged)
+                                           & visible(user_id),
+                                           request.args.get('cursor'),
+                                           request.args.get('limit'))
+    return render_template('showtag.html',
+                           tag=tag,
+                           count=count,
+                           items=items,
+                           next_cursor=next_cursor)
+
+@app.route('/tags/complete/')
+def complete_tag():
+    """Return up to 10 tag names starting with the query in JSON format.
+
+    Only tags with items that the user may see are completed.
+    """
+    prefix = ' '.join(request.args.get('q', '').lower().split())
+    if not prefix:
+        return jsonify(Tags=[])
+    names = db_session.query(Tag.name)\
+                      .filter(prefix_range(prefix),
+                              has_visible_items(login_session.get('user_id')))\
+                      .order_by(Tag.name).limit(10).all()
+    return jsonify(Tags=[n for n, in names])
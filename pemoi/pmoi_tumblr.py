@@ -1,9 +1,20 @@
-import random
+"""Browse Tumblr blogs and save their photos as items.
+
+Tumblr is queried through a small proxy layer: one pooled HTTP session with
+timeouts, an LRU cache of result pages, coalescing of concurrent identical
+queries and prefetching of the next page in a background thread. Set
+TUMBLR_API_URL to test against a local fake server.
+"""
+
 import json
 import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import quote
 
-import pytumblr
-
+import requests
+from requests.adapters import HTTPAdapter
 from flask import flash, \
                   render_template, \
                   redirect, \
@@ -12,15 +23,56 @@ from flask import flash, \
                   session as login_session, \
                   jsonify
 
-from .database_setup import Category, Item
+from .database_setup import Category, Item, TumblrImport
 from .pmoi_db_session import db_session
+from .pmoi_cache import TTLCache
+from .pmoi_helpers import json_response
+from .pmoi_jobs import job_handler, enqueue
+from .pmoi_tags import set_item_tags
 from config import _basedir
 
 from pemoi import app
 
+TUMBLR_API_URL = app.config.get('TUMBLR_API_URL', 'https://api.tumblr.com/v2')
+# Seconds to connect and to wait for the response
+TUMBLR_TIMEOUT = app.config.get('TUMBLR_TIMEOUT', (3.05, 10))
+TUMBLR_POOL_SIZE = app.config.get('TUMBLR_POOL_SIZE', 10)
+TUMBLR_PREFETCH = app.config.get('TUMBLR_PREFETCH', True)
+# Tumblr returns at most 20 posts per query
+TUMBLR_PAGE_SIZE = 20
+# Result pages that a job of a blog import saves in one transaction
+TUMBLR_IMPORT_PAGES = app.config.get('TUMBLR_IMPORT_PAGES', 5)
+
+# Result pages under (blog, tag, offset, limit)
+tumblr_cache = TTLCache(ttl=app.config.get('TUMBLR_CACHE_TTL', 300),
+                        maxsize=app.config.get('TUMBLR_CACHE_SIZE', 1000))
+# Futures of the queries that are currently sent to Tumblr
+_inflight = {}
+_inflight_lock = threading.Lock()
+_prefetcher = ThreadPoolExecutor(max_workers=2)
+
+
+class TumblrError(Exception):
+    """Tumblr could not be reached or answered with an error."""
+
+
+@lru_cache(maxsize=None)
+def get_tumblr_api_key():
+    """Read the Tumblr app ID on first use and reuse it afterwards."""
+    with open(os.path.join(_basedir, 'tumblr_client_secrets.json'), 'r') as f:
+        return json.load(f)['web']['app-id']
+
+@lru_cache(maxsize=None)
+def get_tumblr_session():
+    """Create the HTTP session for Tumblr on first use.
 
-t_app_id = json.loads(open(os.path.join(_basedir, 'tumblr_client_secrets.json'), 'r').read())['web']['app-id']
-tumblr_client = pytumblr.TumblrRestClient(t_app_id)
+    The session keeps up to TUMBLR_POOL_SIZE connections open for reuse.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=TUMBLR_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
 class TumblrPost():
     def __init__(self, blog_name, type, post_url, link, post_id, caption, tags):
@@ -33,27 +85,113 @@ class TumblrPost():
         self.tags = tags
 
 
-def get_tumblr_images(tumblr, limit, offset, tag):
-    posts = []
-    total_posts = 0
+def fetch_tumblr_posts(tumblr, tag, offset, limit):
+    """Query one page of a blog's photo posts from Tumblr.
+
+    Arguments: Blog name, tag (may be empty), offset and limit as int.
+    Return: Tuple (list of TumblrPost objects, number of posts in total).
+    Raises TumblrError if Tumblr can't be reached or answers with an error
+    other than an unknown blog.
+    """
+    if '.' not in tumblr:
+        tumblr = '%s.tumblr.com' % tumblr
+    url = '%s/blog/%s/posts/photo' % (TUMBLR_API_URL, quote(tumblr, safe=''))
+    params = {'api_key': get_tumblr_api_key(), 'limit': limit,
+              'offset': offset}
     if tag:
-        result = tumblr_client.posts(tumblr, type='photo', limit=limit, offset=offset, tag=tag)
-    else:
-        result = tumblr_client.posts(tumblr, type='photo', limit=limit, offset=offset)
-    if 'posts' in result:
-        total_posts = result['total_posts']
-        for post in result['posts']:
-            if 'photos' in post:
-                tumblr_post = TumblrPost(
-                    post['blog_name'],
-                    post['type'],
-                    post['post_url'],
-                    post['photos'][0]['original_size']['url'],
-                    post['id'],
-                    post['photos'][0]['caption'],
-                    post['tags']
-                    )
-                posts.append(tumblr_post)
+        params['tag'] = tag
+    try:
+        response = get_tumblr_session().get(url, params=params,
+                                            timeout=TUMBLR_TIMEOUT)
+    except requests.RequestException as err:
+        # The message of err contains the URL with the API key, so neither
+        # it nor err itself is passed on.
+        raise TumblrError("Tumblr can't be reached (%s)"
+                          % type(err).__name__) from None
+    if response.status_code == 404:
+        return [], 0
+    if response.status_code != 200:
+        raise TumblrError("Tumblr answered with status %d"
+                          % response.status_code)
+    try:
+        result = response.json().get('response', {})
+        found = result.get('posts', [])
+        total_posts = int(result.get('total_posts', 0))
+    except (ValueError, TypeError, AttributeError) as err:
+        raise TumblrError("Unexpected answer from Tumblr: %s" % err)
+    posts = []
+    for post in found:
+        # Skip posts without an image to save
+        try:
+            photo = post['photos'][0]
+            url = photo['original_size']['url']
+            post_id = post['id']
+        except (KeyError, IndexError, TypeError):
+            continue
+        posts.append(TumblrPost(
+            post.get('blog_name', ''),
+            post.get('type', 'photo'),
+            post.get('post_url', ''),
+            url,
+            post_id,
+            photo.get('caption', ''),
+            post.get('tags') or []
+            ))
+    return posts, total_posts
+
+def _coalesced_fetch(key):
+    """Fetch a result page, sharing one upstream query between threads.
+
+    The first thread asking for a page that is neither cached nor in flight
+    queries Tumblr; threads asking for the same page meanwhile wait for its
+    result (or its error).
+    """
+    with _inflight_lock:
+        cached = tumblr_cache.get(key)
+        if cached is not None:
+            return cached
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+    if not leader:
+        return future.result()
+    try:
+        result = fetch_tumblr_posts(*key)
+        tumblr_cache.set(key, result)
+        future.set_result(result)
+        return result
+    except Exception as err:
+        future.set_exception(err)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
+def _prefetch(key):
+    """Load a result page into the cache, in a background thread."""
+    try:
+        _coalesced_fetch(key)
+    except TumblrError as err:
+        app.logger.warning("Prefetching Tumblr page %s failed: %s", key, err)
+    except Exception:
+        # Nobody waits for the result, so the error would go unnoticed
+        app.logger.exception("Prefetching Tumblr page %s failed", key)
+
+def get_tumblr_images(tumblr, limit, offset, tag, prefetch=TUMBLR_PREFETCH):
+    """Get one page of a blog's photo posts.
+
+    Arguments: Blog name, limit and offset as int, tag (may be empty),
+    prefetch as Boolean, whether to load the next page in the background.
+    Return: Tuple (list of TumblrPost objects, number of posts in total).
+    Raises TumblrError, see fetch_tumblr_posts.
+    """
+    key = (tumblr, tag or '', offset, limit)
+    posts, total_posts = _coalesced_fetch(key)
+    next_key = (tumblr, tag or '', offset + limit, limit)
+    if prefetch and offset + limit < total_posts \
+       and tumblr_cache.get(next_key) is None:
+        _prefetcher.submit(_prefetch, next_key)
     return posts, total_posts
 
 @app.route('/save_tumblr/', methods=['POST'])
@@ -72,6 +210,7 @@ def save_tumblr():
             user_id=login_session['user_id'],
             public=False
             )
+    set_item_tags(item)
     db_session.add(item)
     db_session.commit()
     db_session.refresh(item)
@@ -85,9 +224,15 @@ def tumblr():
         offset = int(request.form.get('offset'))
         limit = int(request.form.get('n_items', 20))
         tag = request.form.get('tag').strip()
-        items, total_posts = get_tumblr_images(tumblr_name, limit, offset, tag)
-        if not items:
-            flash("No images found")
+        try:
+            items, total_posts = get_tumblr_images(tumblr_name, limit, offset,
+                                                   tag)
+        except TumblrError:
+            items, total_posts = [], 0
+            flash("Tumblr can not be reached right now, please try again")
+        else:
+            if not items:
+                flash("No images found")
         return render_template(
             'tumblr.html',
             items=items,
@@ -99,3 +244,134 @@ def tumblr():
             max_post=min(total_posts, offset + limit)
             )
     return render_template('tumblr.html')
+
+
+def import_posts(tumblr_import, posts, known=None):
+    """Save Tumblr posts as private items of the importing user.
+
+    Posts whose image the user has saved before are skipped, as are posts
+    with links too long to store.
+    Arguments: TumblrImport object, list of TumblrPost objects, optional
+        dictionary of known tags (see get_or_create_tags).
+    Return: Tuple (number of items created, number of posts skipped).
+    """
+    max_length = Item.link.property.columns[0].type.length
+    links = set(p.link for p in posts if len(p.link) <= max_length)
+    if links:
+        saved = db_session.query(Item.link)\
+                          .filter(Item.user_id==tumblr_import.user_id,
+                                  Item.link.in_(links))
+        links -= set(link for link, in saved)
+    imported = 0
+    for post in posts:
+        if post.link not in links:
+            continue
+        # The same image can appear in several posts
+        links.discard(post.link)
+        item = Item(link=post.link,
+                    title=(post.caption or '')[:250],
+                    artist='',
+                    note=post.post_url,
+                    keywords=', '.join(post.tags)[:250],
+                    category_id=0,
+                    user_id=tumblr_import.user_id,
+                    public=False)
+        set_item_tags(item, known)
+        db_session.add(item)
+        imported += 1
+    return imported, len(posts) - imported
+
+def set_import_status(import_id, status):
+    """Set the status of a Tumblr import.
+
+    Arguments: import_id as int, status as string.
+    """
+    db_session.query(TumblrImport).filter_by(id=import_id)\
+                                  .update({'status': status})
+    db_session.commit()
+
+@job_handler('import_tumblr',
+             on_failure=lambda import_id: set_import_status(import_id,
+                                                            'failed'))
+def import_tumblr(import_id):
+    """Background job: import the next posts of a Tumblr blog.
+
+    Saves up to TUMBLR_IMPORT_PAGES pages of posts and the import's progress
+    in one transaction and queues the job for the following pages.
+    Argument: import_id as int.
+    """
+    tumblr_import = db_session.query(TumblrImport)\
+                              .filter_by(id=import_id).first()
+    if tumblr_import is None or tumblr_import.status in ('done', 'failed'):
+        return
+    tumblr_import.status = 'running'
+    known = {}
+    finished = False
+    for _ in range(TUMBLR_IMPORT_PAGES):
+        posts, total = get_tumblr_images(tumblr_import.blog,
+                                         TUMBLR_PAGE_SIZE,
+                                         tumblr_import.offset,
+                                         tumblr_import.tag)
+        tumblr_import.total = total
+        imported, skipped = import_posts(tumblr_import, posts, known)
+        tumblr_import.imported += imported
+        tumblr_import.skipped += skipped
+        tumblr_import.offset += TUMBLR_PAGE_SIZE
+        if not posts or tumblr_import.offset >= total:
+            finished = True
+            break
+    if finished:
+        tumblr_import.offset = min(tumblr_import.offset,
+                                   tumblr_import.total or 0)
+        tumblr_import.status = 'done'
+        db_session.commit()
+    else:
+        # Committed together with this batch's items and progress
+        enqueue('import_tumblr', import_id=import_id)
+
+@app.route('/tumblr/import/', methods=['POST'])
+def new_tumblr_import():
+    """Start importing a whole Tumblr blog as private items."""
+    if not 'user_id' in login_session:
+        return redirect(url_for('login'))
+    tumblr_name = (request.form.get('name') or '').strip()
+    if not tumblr_name:
+        flash("Please enter a Tumblr name")
+        return redirect(url_for('tumblr'))
+    tumblr_import = TumblrImport(user_id=login_session['user_id'],
+                                 blog=tumblr_name,
+                                 tag=(request.form.get('tag') or '').strip())
+    db_session.add(tumblr_import)
+    db_session.flush()
+    enqueue('import_tumblr', import_id=tumblr_import.id)
+    return redirect(url_for('show_tumblr_import',
+                            import_id=tumblr_import.id))
+
+def get_own_import(import_id):
+    """Return the logged in user's Tumblr import with the given ID or None."""
+    return db_session.query(TumblrImport)\
+                     .filter_by(id=import_id,
+                                user_id=login_session.get('user_id')).first()
+
+@app.route('/tumblr/import/<int:import_id>/')
+def show_tumblr_import(import_id):
+    """Show the progress of a Tumblr import."""
+    if not 'user_id' in login_session:
+        return redirect(url_for('login'))
+    tumblr_import = get_own_import(import_id)
+    if tumblr_import is None:
+        flash("This import does not exist")
+        return redirect(url_for('tumblr'))
+    return render_template('tumblrimport.html', tumblr_import=tumblr_import)
+
+@app.route('/tumblr/import/<int:import_id>/json/')
+def tumblr_import_json(import_id):
+    """Return the progress of a Tumblr import in JSON format."""
+    tumblr_import = get_own_import(import_id)
+    if tumblr_import is None:
+        return json_response("This import does not exist", 404)
+    return jsonify(status=tumblr_import.status,
+                   offset=tumblr_import.offset,
+                   total=tumblr_import.total,
+                   imported=tumblr_import.imported,
+                   skipped=tumblr_import.skipped)
@@ -7,14 +7,21 @@ from flask import render_template, \
                   request, \
                   url_for, \
                   session as login_session
+from sqlalchemy import func, literal
+from sqlalchemy.exc import SQLAlchemyError
 
 from pemoi import app
-from .pmoi_auth import get_user_info
+from .pmoi_auth import get_user_info, queue_revocation
+from .pmoi_user_cache import user_keys, invalidate_user
 from .pmoi_helpers import username_error
-from .pmoi_cat import get_categories
+from .pmoi_cat import get_categories, invalidate_category_menu
 from .pmoi_db_session import db_session
-from .pmoi_item import delete_file_and_row
-from .database_setup import Category, Item, User
+from .pmoi_fragments import invalidate_item_boxes
+from .pmoi_images import variant_filenames
+from .pmoi_jobs import enqueue
+from .pmoi_storage import upload_path, upload_url
+from .pmoi_tags import delete_orphan_tags
+from .database_setup import Category, Item, User, TumblrImport, item_tag
 
 @app.route('/profile/<int:user_id>/')
 def show_profile(user_id):
@@ -48,37 +55,79 @@ def edit_profile(user_id):
     if request.method == 'POST':
         username = request.form['username']
         about = request.form['about']
-        if not user.username == username:
+        renamed = user.username != username
+        if renamed:
             # Verify the changed username
             error = username_error(username)
             if error:
                 flash(error)
                 return render_template('editprofile.html',
                                        user=user)
+        old_username = user.username
+        olddir = os.path.join(app.config['UPLOAD_FOLDER'], old_username)
+        newdir = os.path.join(app.config['UPLOAD_FOLDER'], username)
+        moved = False
+        old_keys = user_keys(user)
         try:
-            # Rename the user's upload directory.
-            olddir = os.path.join(app.config['UPLOAD_FOLDER'], user.username)
-            newdir = os.path.join(app.config['UPLOAD_FOLDER'], username)
-            os.rename(olddir, newdir)
-            # Change the user's file's links
-            items = get_user_items(user.id)
-            for item in items:
-                item.link = item.link.replace("/" + user.username + "/", "/" + username + "/")
-                db_session.add(item)
-        except OSError as err:
-            # If there is a problem renaming the directory, throw an error.
-            # This will have to be handled manually for now.
+            # Uploads are stored by content and don't depend on the username.
+            # Only users with uploads from before the content store (see
+            # 'flask migrate-uploads') still have a directory of their own.
+            if renamed and os.path.isdir(olddir):
+                rewrite_upload_links(user.id, old_username, username)
+                # If there is a problem renaming the directory, throw an
+                # error. This will have to be handled manually for now.
+                os.rename(olddir, newdir)
+                moved = True
+            user.username = username
+            user.about = about
+            db_session.add(user)
+            db_session.commit()
+        except:
+            db_session.rollback()
+            if moved:
+                # Links still point to the old directory
+                os.rename(newdir, olddir)
             raise
-        user.username = username
-        user.about = about
+        invalidate_user(user, old_keys)
         login_session['username'] = username
         login_session['about'] = about
-        db_session.add(user)
-        db_session.commit()
+        if renamed:
+            # Item boxes show the owner's name
+            invalidate_item_boxes([i for i, in db_session.query(Item.id)
+                                                  .filter_by(user_id=user.id)])
         return redirect(url_for('show_profile', user_id=user.id))
     else:
         return render_template('editprofile.html', user=user)
 
+def replace_prefix(column, old, new):
+    """SQL expression that replaces prefix old with new at the start of
+    column and of every entry after ', ' (for srcset values).
+
+    Arguments: column, old and new prefix as strings.
+    """
+    separator = literal(', ')
+    return func.substr(func.replace(separator + column,
+                                    separator + old,
+                                    separator + new), 3)
+
+def rewrite_upload_links(user_id, old_username, new_username):
+    """Point links into a renamed upload directory to the new directory.
+
+    Only links that start with the upload URL of the old directory are
+    changed, external links that merely contain the username are not.
+    A single UPDATE for all of the user's items, in the current transaction.
+    Arguments: user_id as int, old and new username as strings.
+    """
+    old = upload_url(old_username + '/')
+    new = upload_url(new_username + '/')
+    db_session.query(Item)\
+              .filter(Item.user_id==user_id,
+                      Item.link.startswith(old, autoescape=True))\
+              .update({column: replace_prefix(column, old, new)
+                       for column in (Item.link, Item.thumb_link,
+                                      Item.srcset, Item.webp_srcset)},
+                      synchronize_session=False)
+
 @app.route('/profile/<int:user_id>/delete/', methods=['GET', 'POST'])
 def delete_profile(user_id):
     """Delete a user profile.
@@ -135,44 +184,64 @@ def get_user_items(user_id):
 def delete_user(user):
     """Delete a user's profile
 
+    Items, their tags and Tumblr imports are deleted and categories without
+    other users' items are removed, the others are adopted by the admin. All
+    of this happens with a few bulk statements in one transaction, so a
+    failure leaves the account untouched. Uploaded files are deleted
+    afterwards by a background job.
+
     Argument: User object.
     Return: Boolean, indicating success or failure.
     """
-    items = get_user_items(user.id)
-    private_categories = get_user_categories(user.id, False)
-    public_categories = get_user_categories(user.id, True)
-    for item in items:
-                delete_file_and_row(item)
-    for cat in private_categories:
-        db_session.delete(cat)
-        db_session.commit()
-    for cat in public_categories:
-        if not cat.items:
-            # Delete public category if empty.
-            db_session.delete(cat)
-            db_session.commit()
-        else:
-            # Change owner to admin account if not empty.
-            cat.user_id = 0
-            db_session.add(cat)
-            db_session.commit()
+    user_items = db_session.query(Item.id).filter(Item.user_id==user.id)
+    # Only uploads have files to remove, see pmoi_storage.
+    files = [(i.id, i.link, sorted(variant_filenames(i)))
+             for i in db_session.query(Item.id, Item.link, Item.srcset,
+                                       Item.webp_srcset)
+                                .filter(Item.user_id==user.id)]
+    other_items = db_session.query(Item.id)\
+                            .filter(Item.category_id==Category.id)\
+                            .exists()
+    tag_ids = [tag_id for tag_id, in db_session.query(item_tag.c.tag_id)
+               .filter(item_tag.c.item_id.in_(user_items.subquery()))
+               .distinct()]
     try:
-        os.rmdir(os.path.join(app.config['UPLOAD_FOLDER'], user.username))
-    except OSError as err:
+        db_session.execute(item_tag.delete().where(
+            item_tag.c.item_id.in_(user_items.subquery())))
+        delete_orphan_tags(tag_ids)
+        db_session.query(Item).filter_by(user_id=user.id)\
+                  .delete(synchronize_session=False)
+        db_session.query(TumblrImport).filter_by(user_id=user.id)\
+                  .delete(synchronize_session=False)
+        # Categories holding other users' items are adopted by the admin.
+        db_session.query(Category).filter(Category.user_id==user.id,
+                                          other_items)\
+                  .update({'user_id': 0}, synchronize_session=False)
+        db_session.query(Category).filter_by(user_id=user.id)\
+                  .delete(synchronize_session=False)
+        # Replace user's personal information with anonymous unique info.
+        old_username = user.username
+        old_keys = user_keys(user)
+        user.name = ''
+        user.email = 'user_%s_@deleted' % user.id
+        user.username = 'user_%s_deleted' % user.id
+        user.about = ''
+        user.picture = '/static/users/deleteduser.svg'
+        db_session.add(user)
+        db_session.commit()
+    except SQLAlchemyError:
+        db_session.rollback()
         return False
-    # Replace user's personal information with anonymous unique info.
-    user.name = ''
-    user.email = 'user_%s_@deleted' % user.id
-    user.username = 'user_%s_deleted' % user.id
-    user.about = ''
-    user.picture = '/static/users/deleteduser.svg'
-    if 'provider' in login_session:
-        provider = login_session['provider']
-        if provider == 'Google':
-            gdisconnect()
-        elif provider == 'Facebook':
-            fbdisconnect()
-    db_session.add(user)
-    db_session.commit()
+    # The session still refers to deleted rows
+    db_session.expire_all()
+    invalidate_user(user, old_keys)
+    invalidate_category_menu(user.id)
+    invalidate_item_boxes([item_id for item_id, _, _ in files])
+    uploads = [[link, variants] for _, link, variants in files
+               if upload_path(link)]
+    # The upload directory from before the content store is removed once
+    # its files are gone.
+    enqueue('release_item_files', files=uploads, directory=old_username)
+    queue_revocation()
     login_session.clear()
     return True
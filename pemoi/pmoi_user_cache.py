@@ -0,0 +1,83 @@
+"""Cache for looking up users by ID, e-mail or username.
+
+Lookups are cached twice: for the rest of the request (repeated lookups of
+the same user cost nothing) and, for USER_CACHE_TTL seconds, per worker
+process. The process cache holds column values, not objects; a hit is turned
+into a User object of the current session with merge(load=False), which does
+not query the database, unless the session holds the user already. Changes to a user must be followed by
+invalidate_user, changes through other workers become visible after at most
+USER_CACHE_TTL seconds.
+"""
+
+from flask import g, has_app_context
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+
+from pemoi import app
+from .database_setup import User
+from .pmoi_db_session import db_session
+from .pmoi_cache import TTLCache
+
+USER_COLUMNS = ('id', 'name', 'username', 'email', 'picture', 'about',
+                'register_date')
+
+user_cache = TTLCache(ttl=app.config.get('USER_CACHE_TTL', 60),
+                      maxsize=app.config.get('USER_CACHE_SIZE', 10000))
+
+def user_keys(user):
+    """Return the cache keys of a user, one per way of looking it up."""
+    return ['id:%s' % user.id, 'email:%s' % user.email,
+            'username:%s' % user.username]
+
+def _request_cache():
+    """Return the lookups of this request, key -> user ID or None."""
+    if not has_app_context():
+        return {}
+    if 'user_lookups' not in g:
+        g.user_lookups = {}
+    return g.user_lookups
+
+def find_user(column, value):
+    """Get a user by a unique column.
+
+    Arguments: column name ('id', 'email' or 'username'), value.
+    Return: User object or None.
+    """
+    key = '%s:%s' % (column, value)
+    lookups = _request_cache()
+    if key in lookups:
+        user_id = lookups[key]
+        # Found in the session's identity map, without a query
+        if user_id is None:
+            return None
+        return db_session.query(User).get(user_id)
+    values = user_cache.get(key)
+    if values is None:
+        user = db_session.query(User)\
+                         .filter(getattr(User, column)==value).first()
+        if user is None:
+            # Misses are only remembered for this request, so new users are
+            # found right away.
+            lookups[key] = None
+            return None
+        values = dict((c, getattr(user, c)) for c in USER_COLUMNS)
+        for cached_key in user_keys(user):
+            user_cache.set(cached_key, values)
+    else:
+        # A copy in the session may be fresher than the cached values
+        user = db_session.identity_map.get(identity_key(User, values['id']))
+        if user is None:
+            user = User(**values)
+            make_transient_to_detached(user)
+            user = db_session.merge(user, load=False)
+    lookups[key] = user.id
+    return user
+
+def invalidate_user(user, old_keys=()):
+    """Drop a user from the caches after it has changed.
+
+    Arguments: User object, cache keys from before the change (optional, see
+        user_keys), e.g. of a changed username.
+    """
+    user_cache.delete_many(set(user_keys(user)) | set(old_keys))
+    _request_cache().clear()
@@ -146,3 +146,25 @@ function catNameCheck() {
 // input field.
 $("#new-public").on("change", catNameCheck);
 $("#newcategory").on("blur", catNameCheck);
+
+// Suggest existing tags for the keyword that is currently being typed. The
+// keywords input names the tag completion URL in 'data-complete' and a
+// datalist for the suggestions in 'list'.
+$("input[data-complete]").on("input", function() {
+  var $input = $(this);
+  var $list = $("#" + $input.attr("list"));
+  var keywords = $input.val().split(",");
+  var current = keywords.pop().trim();
+  if (!current) {
+    $list.empty();
+    return;
+  }
+  $.getJSON($input.data("complete"), {q: current}, function(result) {
+    $list.empty();
+    $.each(result.Tags, function(i, tag) {
+      // Suggest the complete value, with the current keyword completed
+      var value = keywords.length ? keywords.join(",") + ", " + tag : tag;
+      $list.append($("<option>").attr("value", value));
+    });
+  });
+});
@@ -2,11 +2,14 @@
 """Set up the app config, run server locally"""
 
 from pemoi import app
+from pemoi.pmoi_cli import bootstrap
 
 # app.secret_key = app.config['SECRET_KEY']
 
 
 # Start app locally
 if __name__ == '__main__':
+    # Create or upgrade the local database before serving
+    bootstrap()
     app.debug = True
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,37 @@
+"""Test setup: a config module with a scratch database, and fixtures.
+
+The app reads config.py at import time, so a config module is put in place
+before pemoi is imported.
+"""
+
+import os
+import sys
+import tempfile
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_basedir = tempfile.mkdtemp(prefix='pemoi-tests-')
+config = types.ModuleType('config')
+config._basedir = _basedir
+config.DB_URI = 'sqlite:///' + os.path.join(_basedir, 'pemoi.db')
+config.UPLOAD_FOLDER = os.path.join(_basedir, 'users')
+config.URL_INSERT = ''
+config.SECRET_KEY = 'test'
+config.TESTING = True
+sys.modules['config'] = config
+
+from pemoi import app
+from pemoi.pmoi_cli import bootstrap
+from pemoi.pmoi_db_session import db_session
+
+bootstrap()
+
+@pytest.fixture
+def client():
+    """Test client of the app, the database session is removed after."""
+    yield app.test_client()
+    db_session.remove()
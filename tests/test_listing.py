@@ -0,0 +1,55 @@
+from sqlalchemy import event
+
+from pemoi.database_setup import User, Category, Item
+from pemoi.pmoi_db_session import db_session, engine
+
+PAGES = ('/', '/inspiration/myinspirations/', '/category/100/')
+
+def add_items(n):
+    db_session.add_all([Item(link='http://example.com/%d.jpg' % i,
+                             title='Item %d' % i, user_id=100,
+                             category_id=100, public=True)
+                        for i in range(n)])
+    db_session.commit()
+
+def count_queries(client, url):
+    """Return the number of SQL statements sent while rendering url."""
+    statements = []
+    def count(*args):
+        statements.append(1)
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    assert response.status_code == 200
+    return len(statements)
+
+def test_query_count_does_not_grow_with_items(client):
+    db_session.add(User(id=100, name='Lister', username='lister',
+                        email='lister@example.com'))
+    db_session.add(Category(id=100, name='Listing', user_id=100,
+                            public=True))
+    add_items(1)
+    with client.session_transaction() as session:
+        session['user_id'] = 100
+        session['username'] = 'lister'
+    # Warm up the caches of menus and users
+    for url in PAGES:
+        client.get(url)
+    one = [count_queries(client, url) for url in PAGES]
+    add_items(20)
+    many = [count_queries(client, url) for url in PAGES]
+    assert one == many
+
+def test_category_etag_changes_with_owner(client):
+    db_session.add(User(id=101, name='Owner', username='owner',
+                        email='owner@example.com'))
+    db_session.add(Category(id=101, name='Owned', user_id=101, public=True))
+    db_session.add(Item(link='http://example.com/owned.jpg', title='Owned',
+                        user_id=101, category_id=101, public=True))
+    db_session.commit()
+    before = client.get('/category/101/').headers['ETag']
+    db_session.query(User).get(101).picture = 'http://example.com/me.png'
+    db_session.commit()
+    assert client.get('/category/101/').headers['ETag'] != before
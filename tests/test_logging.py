@@ -0,0 +1,31 @@
+import io
+import json
+import logging
+
+from pemoi.pmoi_logging import configure_logging
+
+def test_pemoi_records_come_out_as_json():
+    logger = logging.getLogger('pemoi')
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    logger.addHandler(handler)
+    formatters = [(h, h.formatter) for h in logger.handlers]
+    try:
+        configure_logging({'LOG_FORMAT': 'json'})
+        logging.getLogger('pemoi.pmoi_helpers').info(
+            "Created admin account", extra={'user_id': 0})
+    finally:
+        logger.removeHandler(handler)
+        for h, formatter in formatters:
+            h.setFormatter(formatter)
+    entry = json.loads(stream.getvalue())
+    assert entry['logger'] == 'pemoi.pmoi_helpers'
+    assert entry['level'] == 'INFO'
+    assert entry['message'] == "Created admin account"
+    assert entry['user_id'] == 0
+
+def test_pemoi_logger_has_a_handler_and_passes_info():
+    logger = logging.getLogger('pemoi')
+    assert logger.handlers
+    assert logging.getLogger('pemoi.database_migrations') \
+                  .isEnabledFor(logging.INFO)
@@ -0,0 +1,22 @@
+from sqlalchemy import create_engine
+
+from pemoi.database_setup import Base
+from pemoi.database_migrations import _create_missing_indexes
+
+def test_duplicate_public_category_names_are_renamed():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    category = Base.metadata.tables['category']
+    with engine.begin() as conn:
+        conn.execute('DROP INDEX ix_category_public_name')
+        conn.execute(category.insert(), [
+            {'id': 1, 'name': 'Posters', 'user_id': 1, 'public': True},
+            {'id': 2, 'name': 'Posters', 'user_id': 2, 'public': True},
+            {'id': 3, 'name': 'Posters (2)', 'user_id': 3, 'public': True},
+            {'id': 4, 'name': 'Posters', 'user_id': 4, 'public': False},
+        ])
+        _create_missing_indexes(conn)
+        names = dict(conn.execute('SELECT id, name FROM category')\
+                         .fetchall())
+    assert names == {1: 'Posters', 2: 'Posters (2-2)', 3: 'Posters (2)',
+                     4: 'Posters'}
@@ -0,0 +1,22 @@
+from pemoi import app
+from pemoi.database_setup import User, Category, Item
+from pemoi.pmoi_db_session import db_session
+from pemoi.pmoi_search import search_items
+
+def test_search_pages_have_no_duplicates(client):
+    db_session.add(User(id=200, name='Seeker', username='seeker',
+                        email='seeker@example.com'))
+    db_session.add(Category(id=200, name='Search', user_id=200, public=True))
+    db_session.add_all([Item(link='http://example.com/s%d.jpg' % i,
+                             title='zebra ' * (1 + i % 3), user_id=200,
+                             category_id=200, public=True)
+                        for i in range(11)])
+    db_session.commit()
+    found, cursor = [], None
+    with app.test_request_context():
+        for _ in range(20):
+            items, cursor = search_items('zebra', cursor=cursor, limit=3)
+            found.extend(item.id for item in items)
+            if cursor is None:
+                break
+    assert len(found) == len(set(found)) == 11
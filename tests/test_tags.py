@@ -0,0 +1,32 @@
+from pemoi.database_setup import User, Category, Item, Tag
+from pemoi.pmoi_db_session import db_session
+from pemoi.pmoi_tags import set_item_tags
+
+def test_private_tags_stay_hidden(client):
+    db_session.add(User(id=300, name='Tagger', username='tagger',
+                        email='tagger@example.com'))
+    db_session.add(Category(id=300, name='Tagged', user_id=300))
+    item = Item(link='http://example.com/t.jpg', title='Secret', user_id=300,
+                category_id=300, keywords='quokka secret', public=False)
+    set_item_tags(item)
+    db_session.add(item)
+    db_session.commit()
+    response = client.get('/tags/complete/?q=quo')
+    assert response.get_json() == {'Tags': []}
+    response = client.get('/tag/quokka/')
+    assert response.status_code == 302
+
+def test_unused_tags_are_deleted(client):
+    db_session.add(User(id=301, name='Retagger', username='retagger',
+                        email='retagger@example.com'))
+    db_session.add(Category(id=301, name='Retagged', user_id=301))
+    item = Item(link='http://example.com/r.jpg', title='Retagged',
+                user_id=301, category_id=301, keywords='wombat')
+    set_item_tags(item)
+    db_session.add(item)
+    db_session.commit()
+    item.keywords = 'numbat'
+    set_item_tags(item)
+    db_session.commit()
+    names = [name for name, in db_session.query(Tag.name)]
+    assert 'wombat' not in names and 'numbat' in names
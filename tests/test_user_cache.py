@@ -0,0 +1,23 @@
+from pemoi import app
+from pemoi.database_setup import User
+from pemoi.pmoi_db_session import db_session
+from pemoi.pmoi_user_cache import find_user, user_cache
+
+def test_admin_with_id_0_is_found_repeatedly(client):
+    with app.test_request_context():
+        assert find_user('id', 0).id == 0
+        assert find_user('id', 0).id == 0
+        assert find_user('username', 'Admin').id == 0
+        assert find_user('username', 'Admin').id == 0
+
+def test_cache_hit_returns_the_session_copy(client):
+    with app.test_request_context():
+        find_user('id', 0)
+    db_session.remove()
+    with app.test_request_context():
+        admin = db_session.query(User).get(0)
+        admin.about = "Changed in this session"
+        assert user_cache.get('id:0') is not None
+        assert find_user('id', 0) is admin
+        assert admin.about == "Changed in this session"
+        db_session.rollback()